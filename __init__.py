@@ -7,7 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import socket, time, re
+import os, socket, time, re
 from threading import Thread
 from Queue import Queue, Empty
 
@@ -36,9 +36,145 @@ class Amazon_CN(Source):
     prefer_results_with_isbn = False
 
     MAX_EDITIONS = 5
+    # With fast identify, the details pages of at most this many of the best
+    # ranked search results are downloaded, and only of those at least this
+    # similar to the book looked for, the others are read from their result
+    # blocks only
+    FAST_DETAILS = 2
+    FAST_DETAILS_SIMILARITY = 0.5
+
+    options = (
+            Option('persistent_cache', 'bool', True,
+                _('Remember downloaded results on disk'),
+                _('Keep the ISBN to Amazon id mapping, cover urls and metadata '
+                  'downloaded from Amazon.cn on disk, so that downloading them '
+                  'again does not need to contact Amazon.cn.')),
+            Option('cache_ttl_days', 'number', 30,
+                _('Days to remember results for'),
+                _('Results remembered on disk are downloaded again after this '
+                  'many days.')),
+            Option('cache_max_entries', 'number', 500000,
+                _('Maximum number of remembered results'),
+                _('The least recently used results are forgotten once more '
+                  'than this many are remembered.')),
+            Option('response_cache', 'bool', True,
+                _('Remember downloaded pages'),
+                _('Keep downloaded pages, and the metadata read from them, '
+                  'on disk. Pages are only downloaded again if Amazon.cn '
+                  'says they changed and are not parsed again if they did '
+                  'not.')),
+            Option('response_cache_mb', 'number', 100,
+                _('Space for remembered pages (MB)'),
+                _('The least recently used pages are forgotten once the '
+                  'remembered pages use more than this much disk space.')),
+            Option('negative_cache', 'bool', True,
+                _('Remember searches that found nothing'),
+                _('Do not search Amazon.cn again for books it found no '
+                  'matches for recently. Needs results to be remembered on '
+                  'disk.')),
+            Option('negative_cache_hours', 'number', 72,
+                _('Hours to remember searches that found nothing for'),
+                _('Searches that found nothing are made again after this '
+                  'many hours, in case Amazon.cn has added the book since.')),
+            Option('max_concurrent_fetches', 'number', 5,
+                _('Maximum simultaneous downloads'),
+                _('The maximum number of pages downloaded from Amazon.cn at '
+                  'the same time.')),
+            Option('requests_per_second', 'number', 10,
+                _('Maximum downloads per second'),
+                _('Downloads from Amazon.cn are started at no more than this '
+                  'rate.')),
+            Option('fetch_engine', 'choices', 'threads',
+                _('Download engine'),
+                _('How details pages are downloaded. With one thread per page '
+                  'every page gets its own thread and browser. The shared pool '
+                  'uses a fixed set of download threads for all searches, '
+                  'which is better when downloading metadata for many books.'),
+                {'threads': _('One thread per page'),
+                 'pool': _('Shared pool')}),
+            Option('parser_threads', 'number', 2,
+                _('Parser threads'),
+                _('Number of threads parsing downloaded pages when using the '
+                  'shared pool download engine.')),
+            Option('parse_processes', 'number', 0,
+                _('Parser processes'),
+                _('Parse downloaded pages in this many separate processes, '
+                  'so that parsing the pages of many books uses more than '
+                  'one CPU core. 0 parses them in the downloading threads. '
+                  'Not available on Windows.')),
+            Option('connection_pool', 'bool', True,
+                _('Reuse connections'),
+                _('Keep connections to Amazon.cn open and reuse them for '
+                  'later downloads, instead of opening a new connection for '
+                  'every page and cover. calibre\'s proxy settings are used and '
+                  'the cookies set by Amazon.cn are kept, as with calibre\'s '
+                  'own downloads.')),
+            Option('metrics_file', 'string', '',
+                _('Metrics file'),
+                _('If set, timings of each phase of downloading metadata and '
+                  'covers, bytes downloaded and errors are written to this '
+                  'file after every download. Files ending in .json are '
+                  'written as JSON, others in the Prometheus text format.')),
+            Option('profile_identify', 'bool', False,
+                _('Profile metadata downloads'),
+                _('Profile every metadata download with cProfile, including '
+                  'the downloading and parsing of details pages in other '
+                  'threads. The profile is written next to the metrics file '
+                  'if one is set, otherwise a summary is written to the '
+                  'log.')),
+            Option('parser', 'choices', 'lxml',
+                _('HTML parser'),
+                _('lxml is much faster, pages it cannot make sense of are '
+                  'parsed again with html5lib. html5lib parses every page '
+                  'like a browser would, but slowly.'),
+                {'lxml': 'lxml', 'html5lib': 'html5lib'}),
+            Option('stream_search', 'bool', True,
+                _('Fast search results parsing'),
+                _('Pick the links out of search results pages while they are '
+                  'read, stopping as soon as enough have been found, instead '
+                  'of parsing the whole page. Pages this does not find any '
+                  'links in are parsed normally.')),
+            Option('partial_details', 'bool', True,
+                _('Low memory details parsing'),
+                _('Keep only the parts of book details pages that metadata '
+                  'is read from while they are parsed, instead of the whole '
+                  'page. This uses much less memory when many books are '
+                  'downloaded at once.')),
+            Option('fast_identify', 'bool', False,
+                _('Fast metadata download'),
+                _('Read the title, authors, rating and cover of books from '
+                  'the search results page, and download the page of a book '
+                  'only if other fields are needed (see the fields to '
+                  'download in the metadata download settings). Search '
+                  'results are ranked by how well their titles and authors '
+                  'match, only the pages of the best one or two are '
+                  'downloaded.')),
+            Option('confidence_threshold', 'number', 90,
+                _('Confident match (%)'),
+                _('Stop downloading the less relevant search results once '
+                  'one matches what was looked for with at least this '
+                  'confidence. An ISBN or Amazon id match is 100%, an exact '
+                  'title and authors match 95%. The number of search results '
+                  'downloaded is also adapted to where confident matches '
+                  'were found recently. Set to 0 to always download all of '
+                  'them.')),
+    )
 
     def __init__(self, *args, **kwargs):
         Source.__init__(self, *args, **kwargs)
+        from calibre_plugins.AMAZON_CN.cover import CoverProbes
+        self.cover_probes = CoverProbes(
+                on_found=self.cache_identifier_to_cover_url)
+        from calibre_plugins.AMAZON_CN.confidence import EditionsLimit
+        self.editions_limit = EditionsLimit(self.MAX_EDITIONS)
+        # ASIN -> url of the biggest cover, see download_best_cover()
+        self._best_cover_urls = {}
+        # The cookies Amazon set, sent by all the pooled browsers of the
+        # plugin as by clones of a mechanize browser
+        from cookielib import CookieJar
+        self.cookies = CookieJar()
+        # Failures of the caches, see cache_failed()
+        self.cache_errors = []
 
     def test_fields(self, mi):
         '''
@@ -52,6 +188,20 @@ class Amazon_CN(Source):
             elif mi.is_null(key):
                 return key
 
+    @property
+    def browser(self):
+        br = Source.browser.fget(self)
+        if self.prefs['connection_pool']:
+            from calibre_plugins.AMAZON_CN.connection import (get_pool,
+                    PooledBrowser)
+            br = PooledBrowser(get_pool(), br.addheaders,
+                    cookies=self.cookies)
+        cache = self.response_cache
+        if cache is not None:
+            from calibre_plugins.AMAZON_CN.connection import CachingBrowser
+            br = CachingBrowser(br, cache, on_error=self.cache_failed)
+        return br
+
     @property
     def user_agent(self):
         # Pass in an index to random_user_agent() to test with a particular
@@ -72,6 +222,28 @@ class Amazon_CN(Source):
             idtype = 'amazon_cn'
             return (idtype, asin, url)
 
+    def missing_fields(self, mi):
+        '''
+        The fields from self.touched_fields that are null on the mi object
+        and that the user has not turned off in the metadata download
+        settings.
+        '''
+        try:
+            from calibre.ebooks.metadata.sources.prefs import msprefs
+            ignore = frozenset(msprefs['ignore_fields'])
+        except Exception:
+            ignore = frozenset()
+        ans = []
+        for key in self.touched_fields:
+            if key in ignore:
+                continue
+            if key.startswith('identifier:'):
+                if not mi.has_identifier(key.partition(':')[-1]):
+                    ans.append(key)
+            elif mi.is_null(key):
+                ans.append(key)
+        return ans
+
     def get_book_url_name(self, idtype, idval, url):
         return self.name
 
@@ -133,99 +305,508 @@ class Amazon_CN(Source):
 
     # }}}
 
-    def get_cached_cover_url(self, identifiers):  # {{{
-        url = None
+    @property
+    def persistent_cache(self):
+        if not self.prefs['persistent_cache']:
+            return None
+        from calibre_plugins.AMAZON_CN.cache import get_cache
+        try:
+            return get_cache(ttl=self.prefs['cache_ttl_days'] * 24 * 3600,
+                    max_entries=self.prefs['cache_max_entries'])
+        except Exception:
+            self.cache_failed('Failed to open the persistent cache, it is'
+                    ' disabled')
+            return None
+
+    @property
+    def response_cache(self):
+        if (not self.prefs['response_cache'] or
+                getattr(self, 'running_a_test', False)):
+            return None
+        from calibre_plugins.AMAZON_CN.cache import get_response_cache
+        try:
+            return get_response_cache(
+                    max_bytes=int(self.prefs['response_cache_mb'] * 1024 * 1024))
+        except Exception:
+            self.cache_failed('Failed to open the response cache, it is'
+                    ' disabled')
+            return None
+
+    MAX_CACHE_ERRORS = 100
+
+    def cache_failed(self, msg):
+        '''
+        Remember the exception being handled, a failure of one of the caches,
+        to be written to the log of the identify() or download_cover() call
+        it happened in by log_cache_errors(). The caches are used from
+        threads and methods that have no log.
+        '''
+        import traceback
+        with self.cache_lock:
+            if len(self.cache_errors) < self.MAX_CACHE_ERRORS:
+                self.cache_errors.append((msg, traceback.format_exc()))
+
+    def log_cache_errors(self, log):
+        with self.cache_lock:
+            errors, self.cache_errors = self.cache_errors, []
+        seen = set()
+        for msg, tb in errors:
+            if (msg, tb) not in seen:
+                seen.add((msg, tb))
+                log.error(msg + ':\n' + tb)
+
+    @property
+    def scheduler(self):
+        from calibre_plugins.AMAZON_CN.scheduler import get_scheduler
+        return get_scheduler(rate=max(0.1, self.prefs['requests_per_second']),
+                max_concurrent=max(1, int(self.prefs['max_concurrent_fetches'])))
+
+    @property
+    def fetch_engine(self):
+        from calibre_plugins.AMAZON_CN.engine import get_engine
+        # Every parser thread keeps at most one parser process busy
+        return get_engine(self.prefs['fetch_engine'],
+                fetchers=max(1, int(self.prefs['max_concurrent_fetches'])),
+                parsers=max(1, int(self.prefs['parser_threads']),
+                    int(self.prefs['parse_processes'])))
+
+    @property
+    def parse_pool(self):
+        return self.get_parse_pool()
+
+    def get_parse_pool(self, restart=False):
+        processes = int(self.prefs['parse_processes'])
+        if processes < 1:
+            return None
+        from calibre_plugins.AMAZON_CN.parsepool import get_parse_pool
+        return get_parse_pool(processes, restart=restart)
+
+    def start_parse_pool(self, log):
+        '''
+        Fork the parser processes, if any, before a lookup starts its threads,
+        see ParsePool.
+        '''
+        try:
+            self.get_parse_pool(restart=True)
+        except Exception:
+            log.exception('Failed to start the parser processes, parsing in'
+                    ' the downloading threads instead')
+
+    def _cache_get(self, kind, key):
+        pc = self.persistent_cache
+        if pc is not None:
+            try:
+                return pc.get(kind, key)
+            except Exception:
+                self.cache_failed('Failed to read %s from the persistent cache'
+                        % kind)
+
+    def _cache_set(self, kind, key, value):
+        pc = self.persistent_cache
+        if pc is not None:
+            try:
+                pc.set(kind, key, value)
+            except Exception:
+                self.cache_failed('Failed to write %s to the persistent cache'
+                        % kind)
+
+    def _cache_delete(self, kind, key):
+        pc = self.persistent_cache
+        if pc is not None:
+            try:
+                pc.delete(kind, key)
+            except Exception:
+                self.cache_failed('Failed to delete %s from the persistent'
+                        ' cache' % kind)
+
+    def cache_isbn_to_identifier(self, isbn, identifier):
+        Source.cache_isbn_to_identifier(self, isbn, identifier)
+        self._cache_set('isbn', isbn, identifier.encode('utf-8'))
+
+    def cached_isbn_to_identifier(self, isbn):
+        ans = Source.cached_isbn_to_identifier(self, isbn)
+        if ans is None:
+            ans = self._cache_get('isbn', isbn)
+            if ans is not None:
+                ans = ans.decode('utf-8')
+                Source.cache_isbn_to_identifier(self, isbn, ans)
+        return ans
+
+    def cache_identifier_to_cover_url(self, id_, url):
+        Source.cache_identifier_to_cover_url(self, id_, url)
+        self._cache_set('cover', id_, url.encode('utf-8'))
+
+    def cached_identifier_to_cover_url(self, id_):
+        ans = Source.cached_identifier_to_cover_url(self, id_)
+        if ans is None:
+            ans = self._cache_get('cover', id_)
+            if ans is not None:
+                ans = ans.decode('utf-8')
+                Source.cache_identifier_to_cover_url(self, id_, ans)
+        return ans
+
+    def cache_identifier_to_metadata(self, id_, mi):
+        if self.persistent_cache is None:
+            return
+        from calibre.ebooks.metadata.opf2 import metadata_to_opf
+        self._cache_set('metadata', id_, metadata_to_opf(mi))
+
+    def cached_identifier_to_metadata(self, id_):
+        raw = self._cache_get('metadata', id_)
+        if raw is None:
+            return None
+        import os
+        from io import BytesIO
+        from calibre.ebooks.metadata.opf2 import OPF
+        try:
+            return OPF(BytesIO(raw), basedir=os.getcwdu(),
+                    populate_spine=False).to_book_metadata()
+        except Exception:
+            return None
+
+    def cache_query_miss(self, query):
+        '''
+        Remember that the search query found no matches.
+        '''
+        from calibre_plugins.AMAZON_CN.cache import normalize_query_url
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        if not self.prefs['negative_cache'] or self.persistent_cache is None:
+            return
+        expires = time.time() + self.prefs['negative_cache_hours'] * 3600
+        self._cache_set('miss', normalize_query_url(query),
+                repr(expires).encode('ascii'))
+        metrics.count('negative_cache', 'stored')
+
+    def cached_query_miss(self, query):
+        '''
+        True if the search query found no matches recently.
+        '''
+        from calibre_plugins.AMAZON_CN.cache import normalize_query_url
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        if not self.prefs['negative_cache'] or self.persistent_cache is None:
+            return False
+        key = normalize_query_url(query)
+        expires = self._cache_get('miss', key)
+        ans = expires is not None and float(expires) > time.time()
+        if expires is not None and not ans:
+            self._cache_delete('miss', key)
+        metrics.count('negative_cache', 'hit' if ans else 'miss')
+        return ans
+
+    def get_cached_asin(self, identifiers):
         asin = self.get_asin(identifiers)
         if asin is None:
             isbn = identifiers.get('isbn', None)
             if isbn is not None:
                 asin = self.cached_isbn_to_identifier(isbn)
+        return asin
+
+    def get_cached_cover_url(self, identifiers):  # {{{
+        url = None
+        asin = self.get_cached_asin(identifiers)
         if asin is not None:
             url = self.cached_identifier_to_cover_url(asin)
 
         return url
     # }}}
 
-    def parse_results_page(self, root):  # {{{
+    def iter_results_page(self, root, generation=None, limit=None):  # {{{
+        '''
+        Yield the urls of up to limit (MAX_EDITIONS by default) detail pages
+        linked from a search results page, most relevant first, as soon as
+        each one is found. generation is the markup generation of the page,
+        as returned by results_generation(), if known; its links are looked
+        for first.
+        '''
+        from itertools import islice
+        return islice(self._iter_results_page(root, generation),
+                limit or self.MAX_EDITIONS)
+
+    def _iter_results_page(self, root, generation):
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+
+        strategies = [('s_access', self._results_s_access),
+                ('result_div', self._results_divs),
+                # This can happen for some user agents that Amazon thinks are
+                # mobile/less capable
+                ('mobile', self._results_mobile)]
+        if generation is not None:
+            metrics.count('generation', 'search.' + generation)
+            strategies.sort(key=lambda x: x[0] != generation)
+        for name, strategy in strategies:
+            found = False
+            for url in strategy(root):
+                found = True
+                yield url
+            if found:
+                break
+            if name == generation:
+                metrics.count('generation_miss', 'search.' + generation)
+
+    def _results_title_ok(self, a):
         from lxml.html import tostring
+        from calibre_plugins.AMAZON_CN.parsing import results_title_ok
+        return results_title_ok(tostring(a, method='text', encoding=unicode))
 
-        matches = []
-
-        def title_ok(title):
-            title = title.lower()
-            bad = [u'套装', u'[有声书]', u'[音频cd]']
-            for x in bad:
-                if x in title:
-                    return False
-            return True
-
-        for a in root.xpath(r'//li[starts-with(@id, "result_")]//a[@href and contains(@class, "s-access-detail-page")]'):
-            title = tostring(a, method='text', encoding=unicode)
-            if title_ok(title):
-                url = a.get('href')
-                if url.startswith('/'):
-                    url = 'http://www.amazon.cn%s' % (url)
-                matches.append(url)
-
-        if not matches:
-            # Previous generation of results page markup
-            for div in root.xpath(r'//div[starts-with(@id, "result_")]'):
-                links = div.xpath(r'descendant::a[@class="title" and @href]')
-                if not links:
-                    # New amazon markup
-                    links = div.xpath('descendant::h3/a[@href]')
-                for a in links:
-                    title = tostring(a, method='text', encoding=unicode)
-                    if title_ok(title):
-                        url = a.get('href')
-                        if url.startswith('/'):
-                            url = 'http://www.amazon.cn%s' % (url)
-                        matches.append(url)
-                    break
+    def _results_s_access(self, root):
+        from calibre_plugins.AMAZON_CN import xpaths
+        from calibre_plugins.AMAZON_CN.parsing import results_url
+        for a in xpaths.result_links(root):
+            if self._results_title_ok(a):
+                yield results_url(a.get('href'))
 
-        if not matches:
-            # This can happen for some user agents that Amazon thinks are
-            # mobile/less capable
-            for td in root.xpath(
-                r'//div[@id="Results"]/descendant::td[starts-with(@id, "search:Td:")]'):
-                for a in td.xpath(r'descendant::td[@class="dataColumn"]/descendant::a[@href]/span[@class="srTitle"]/..'):
-                    title = tostring(a, method='text', encoding=unicode)
-                    if title_ok(title):
-                        url = a.get('href')
-                        if url.startswith('/'):
-                            url = 'http:/www.amazon.cn%s' % (url)
-                        matches.append(url)
-                    break
+    def _results_divs(self, root):
+        # Previous generation of results page markup
+        from calibre_plugins.AMAZON_CN import xpaths
+        from calibre_plugins.AMAZON_CN.parsing import results_url
+        for div in xpaths.result_divs(root):
+            links = xpaths.result_div_title_links(div)
+            if not links:
+                # New amazon markup
+                links = xpaths.result_div_h3_links(div)
+            for a in links:
+                if self._results_title_ok(a):
+                    yield results_url(a.get('href'))
+                break
+
+    def _results_mobile(self, root):
+        from calibre_plugins.AMAZON_CN import xpaths
+        from calibre_plugins.AMAZON_CN.parsing import results_url
+        for td in xpaths.result_mobile_tds(root):
+            for a in xpaths.result_mobile_links(td):
+                if self._results_title_ok(a):
+                    yield results_url(a.get('href'))
+                break
+
+    def parse_results_blocks(self, root, title=None, authors=None, limit=None):
+        '''
+        Return (Metadata, cover url, details url, similarity) for the best
+        limit (MAX_EDITIONS by default) result blocks of a search results
+        page, built from what the blocks show. The blocks are ranked by how
+        well their title and authors match title and authors (similarity,
+        None if neither is given), ties in Amazon's order. Only the current
+        generation of markup has result blocks, for other pages the list is
+        empty.
+        '''
+        from calibre_plugins.AMAZON_CN import xpaths
+        from calibre_plugins.AMAZON_CN.confidence import similarity
+        from calibre_plugins.AMAZON_CN.cover import full_size_cover_url
+        from calibre_plugins.AMAZON_CN.parsing import results_url
+        from lxml.html import tostring
 
+        def text(elem):
+            return tostring(elem, method='text', encoding=unicode).strip()
+
+        ans = []
+        for li in xpaths.result_items(root):
+            links = [a for a in xpaths.result_item_links(li) if
+                    self._results_title_ok(a)]
+            if not links:
+                continue
+            btitle = text(links[0])
+            bauthors = []
+            for span in xpaths.result_item_bylines(li):
+                for a in re.split(r'[,，、;；]| and ', text(span)):
+                    a = re.sub(r'\s*[(（][^)）]*[)）]$|^(by|作者[:：])\s*', '',
+                            a.strip()).strip()
+                    if a and a.lower() != 'by':
+                        bauthors.append(a)
+            if not btitle or not bauthors:
+                continue
+            mi = Metadata(btitle, bauthors)
+            mi.set_identifier('amazon_cn', li.get('data-asin'))
+            for star in xpaths.result_item_stars(li):
+                m = re.search(r'[0-9.]+', text(star))
+                if m is not None:
+                    try:
+                        mi.rating = float(m.group())
+                    except ValueError:
+                        pass
+                break
+            cover_url = None
+            for img in xpaths.result_item_imgs(li):
+                cover_url = full_size_cover_url(img.get('src'))
+                break
+            mi.has_cover = bool(cover_url)
+            score = None
+            if title or authors:
+                score = similarity(title, authors, mi.title, mi.authors)
+            ans.append((mi, cover_url, results_url(links[0].get('href')), score))
+        if title or authors:
+            # sort() is stable, equally similar results keep Amazon's order
+            ans.sort(key=lambda x: -x[3])
+        return ans[:limit or self.MAX_EDITIONS]
+
+    def parse_results_page(self, root):
         # Keep only the top MAX_EDITIONS matches as the matches are sorted by relevance
         # by Amazon so lower matches are not likely to be very relevant
-        return matches[:self.MAX_EDITIONS]
+        return list(self.iter_results_page(root))
     # }}}
 
+    def dump_metrics(self, log):
+        '''
+        Write the metrics collected so far to the file set in the options,
+        if any.
+        '''
+        path = self.prefs['metrics_file']
+        if not path:
+            return
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        from calibre_plugins.AMAZON_CN.parsing import parser_stats
+        gauges = dict(('parsed_with_' + k, v) for k, v in
+                parser_stats().iteritems())
+        if self.prefs['connection_pool']:
+            from calibre_plugins.AMAZON_CN.connection import get_pool
+            gauges.update(('connection_pool_' + k, v) for k, v in
+                    get_pool().counters().iteritems())
+        gauges.update(('scheduler_' + k, v) for k, v in
+                self.scheduler.gauges().iteritems())
+        cache = self.response_cache
+        if cache is not None:
+            try:
+                gauges.update(('response_cache_' + k, v) for k, v in
+                        cache.counters().iteritems())
+            except Exception:
+                pass
+        try:
+            metrics.dump(path, gauges)
+        except Exception:
+            log.exception('Failed to write metrics to:', path)
+
     def identify(self, log, result_queue, abort, title=None, authors=None,
             identifiers={}, timeout=30):  # {{{
         '''
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
         '''
+        from calibre_plugins.AMAZON_CN.cancel import following
+        from calibre_plugins.AMAZON_CN.metrics import metrics, profiled
+        self.start_parse_pool(log)
+        try:
+            # Requests in flight are interrupted as soon as abort is set
+            with following(abort) as abort, metrics.timer('identify'):
+                if not self.prefs['profile_identify']:
+                    return self._identify(log, result_queue, abort,
+                            title=title, authors=authors,
+                            identifiers=identifiers, timeout=timeout)
+                path = None
+                if self.prefs['metrics_file']:
+                    path = '%s-identify-%d.prof' % (
+                            os.path.splitext(self.prefs['metrics_file'])[0],
+                            int(time.time() * 1000))
+                with profiled(log, path):
+                    return self._identify(log, result_queue, abort,
+                            title=title, authors=authors,
+                            identifiers=identifiers, timeout=timeout)
+        finally:
+            self.log_cache_errors(log)
+            self.dump_metrics(log)
+
+    def _identify(self, log, result_queue, abort, title=None, authors=None,
+            identifiers={}, timeout=30):
+        '''
+        abort is a Cancel, see identify().
+        '''
+        from itertools import chain
         from calibre.utils.cleantext import clean_ascii_chars
         from calibre.ebooks.chardet import xml_to_unicode
         from lxml.html import tostring
-        import html5lib
+        from calibre_plugins.AMAZON_CN.cancel import Cancelled, scope
+        from calibre_plugins.AMAZON_CN.flight import get_flight
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        from calibre_plugins.AMAZON_CN.parsing import (parse_html,
+                RESULTS_PAGE_REQUIRED, results_generation, stream_results_page,
+                response_charset)
+        from calibre_plugins.AMAZON_CN.scheduler import (check_response,
+                is_throttle_error)
 
         testing = getattr(self, 'running_a_test', False)
 
+        asin = self.get_cached_asin(identifiers)
+        if asin is not None and not testing:
+            mi = self.cached_identifier_to_metadata(asin)
+            if mi is not None:
+                log('Using metadata remembered for:', asin)
+                mi.source_relevance = 0
+                mi.has_cover = bool(self.cached_identifier_to_cover_url(asin))
+                result_queue.put(mi)
+                return
+
+        if asin is not None:
+            # The details page url is known, no need for a search
+            w = self.identify_by_asin(log, result_queue, abort, asin,
+                    timeout=timeout)
+            if w.error is not None:
+                return as_unicode(w.error)
+            if not w.not_found:
+                return
+            log('No details page for %s, searching for it instead' % asin)
+
+        limit, rq, confident = self.MAX_EDITIONS, result_queue, None
+        threshold = self.prefs['confidence_threshold']
+        if threshold > 0 and not testing:
+            from calibre_plugins.AMAZON_CN.confidence import ConfidentQueue
+            limit = self.editions_limit()
+            rq = ConfidentQueue(result_queue, threshold / 100, title=title,
+                    authors=authors, identifiers=identifiers)
+            confident = rq.confident
+
         query = self.create_query(log, title=title, authors=authors,
                 identifiers=identifiers)
         if query is None:
             log.error('Insufficient metadata to construct query')
             return
+        if not testing and self.cached_query_miss(query):
+            if identifiers and title and authors:
+                log('No matches found with identifiers recently, using only'
+                        ' title and authors. Query: %r'%query)
+                return self._identify(log, result_queue, abort, title=title,
+                        authors=authors, timeout=timeout)
+            log.error('No matches found with query recently: %r'%query)
+            return
         br = self.browser
         if testing:
             print ('Using user agent for amazon.cn: %s'%self.user_agent)
+        fast = self.prefs['fast_identify'] and not testing
+        # Fast identify needs the result blocks, not just the links
+        stream = self.prefs['stream_search'] and not testing and not fast
+
+        def search():
+            with self.scheduler.slot(), scope(abort), \
+                    metrics.timer('fetch.search'):
+                res = br.open_novisit(query, timeout=timeout)
+                raw = check_response(res.read().strip())
+            metrics.count('bytes', 'search', len(raw))
+            return raw, response_charset(res)
+
+        def streamed(urls):
+            # The links found so far, until parsing fails
+            spent = 0
+            try:
+                while True:
+                    st = time.time()
+                    try:
+                        url = next(urls)
+                    except StopIteration:
+                        break
+                    finally:
+                        spent += time.time() - st
+                    yield url
+            except Exception:
+                log.exception('Failed to stream parse amazon page for query: %r'%query)
+            finally:
+                metrics.observe('parse.search_stream', spent)
+
         try:
-            raw = br.open_novisit(query, timeout=timeout).read().strip()
+            # Concurrent lookups of the same book share one search
+            raw, charset = get_flight('search').do(query, search)
         except Exception as e:
+            if isinstance(e, Cancelled) or abort.is_set():
+                return
+            if is_throttle_error(e):
+                msg = _('Amazon.cn is limiting requests. Try again later.')
+                log.error(msg)
+                return as_unicode(msg)
             if callable(getattr(e, 'getcode', None)) and \
                     e.getcode() == 404:
                 log.error('Query malformed: %r'%query)
@@ -240,78 +821,284 @@ class Amazon_CN(Source):
                 log.exception(msg)
             return as_unicode(msg)
 
-        raw = clean_ascii_chars(xml_to_unicode(raw,
-            strip_encoding_pats=True, resolve_entities=True)[0])
+        urls = None
+        if stream:
+            # Details pages are downloaded while the rest of the page is
+            # parsed, the DOM is only needed if no link can be found
+            urls = streamed(stream_results_page(raw, limit, encoding=charset))
+            first = next(urls, None)
+            urls = None if first is None else chain((first,), urls)
+            metrics.count('search_parse', 'stream' if urls else 'dom')
+        found = bool(urls)
 
-        if testing:
-            import tempfile
-            with tempfile.NamedTemporaryFile(prefix='amazon_results_',
-                    suffix='.html', delete=False) as f:
-                f.write(raw.encode('utf-8'))
-            print ('Downloaded html for results page saved in', f.name)
+        if not found:
+            with metrics.timer('decode.search'):
+                raw = clean_ascii_chars(xml_to_unicode(raw,
+                    strip_encoding_pats=True, resolve_entities=True)[0])
 
-        matches = []
-        found = '<title>404 - ' not in raw
+            if testing:
+                import tempfile
+                with tempfile.NamedTemporaryFile(prefix='amazon_results_',
+                        suffix='.html', delete=False) as f:
+                    f.write(raw.encode('utf-8'))
+                print ('Downloaded html for results page saved in', f.name)
 
-        if found:
-            try:
-                root = html5lib.parse(raw, treebuilder='lxml',
-                        namespaceHTMLElements=False)
-            except:
-                msg = 'Failed to parse amazon page for query: %r'%query
-                log.exception(msg)
-                return msg
+            found = '<title>404 - ' not in raw
 
-                errmsg = root.xpath('//*[@id="errorMessage"]')
-                if errmsg:
-                    msg = tostring(errmsg, method='text', encoding=unicode).strip()
-                    log.error(msg)
-                    # The error is almost always a not found error
-                    found = False
+            if found:
+                try:
+                    with metrics.timer('parse.search'):
+                        root = parse_html(raw, required=RESULTS_PAGE_REQUIRED,
+                                backend=self.prefs['parser'], log=log)
+                except:
+                    msg = 'Failed to parse amazon page for query: %r'%query
+                    log.exception(msg)
+                    return msg
+
+                    errmsg = root.xpath('//*[@id="errorMessage"]')
+                    if errmsg:
+                        msg = tostring(errmsg, method='text', encoding=unicode).strip()
+                        log.error(msg)
+                        # The error is almost always a not found error
+                        found = False
 
-        if found:
-            matches = self.parse_results_page(root)
+        from calibre_plugins.AMAZON_CN.worker import Worker
+        engine = self.fetch_engine
+        workers, fast_results = [], 0
+        if found and fast:
+            for i, (mi, cover_url, url, score) in enumerate(
+                    self.parse_results_blocks(root, title=title,
+                        authors=authors, limit=limit)):
+                if abort.is_set():
+                    break
+                # Blocks lack most fields, only the best matches are worth
+                # their details page
+                missing = (i < self.FAST_DETAILS and (score is None or
+                    score >= self.FAST_DETAILS_SIMILARITY) and
+                    self.missing_fields(mi))
+                if missing:
+                    log('Downloading %s for: %s' % (', '.join(missing), url))
+                    w = Worker(url, rq, br, log, i, self, testing=testing,
+                            clone_browser=engine.clone_browser,
+                            cancel=abort.child(),
+                            aborted=abort)
+                    workers.append(engine.submit(w))
+                    continue
+                if cover_url:
+                    self.cache_identifier_to_cover_url(
+                            mi.get_identifiers()['amazon_cn'], cover_url)
+                mi.source_relevance = i
+                self.clean_downloaded_metadata(mi)
+                rq.put(mi)
+                fast_results += 1
+            if workers or fast_results:
+                metrics.count('fast_identify', 'details', len(workers))
+                metrics.count('fast_identify', 'results_only', fast_results)
+            else:
+                # No result blocks in this generation of the markup
+                fast = False
+        if found and not fast:
+            # Start fetching each details page as soon as its link is found,
+            # the scheduler paces the actual requests
+            if not urls:
+                urls = self.iter_results_page(root, results_generation(raw),
+                        limit)
+            for i, url in enumerate(urls):
+                if abort.is_set():
+                    break
+                w = Worker(url, rq, br, log, i, self, testing=testing,
+                        clone_browser=engine.clone_browser,
+                        cancel=abort.child(),
+                        aborted=abort)
+                workers.append(engine.submit(w))
 
         if abort.is_set():
             return
 
-        if not matches:
+        if not workers and not fast_results:
+            if not testing:
+                self.cache_query_miss(query)
             if identifiers and title and authors:
                 log('No matches found with identifiers, retrying using only'
                         ' title and authors. Query: %r'%query)
-                return self.identify(log, result_queue, abort, title=title,
+                return self._identify(log, result_queue, abort, title=title,
                         authors=authors, timeout=timeout)
             log.error('No matches found with query: %r'%query)
             return
 
-        from calibre_plugins.AMAZON_CN.worker import Worker
-        workers = [Worker(url, result_queue, br, log, i, self,
-                            testing=testing) for i, url in enumerate(matches)]
+        skipped = set()
 
-        for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
+        def pending():
+            # The workers still worth waiting for: once a confident match is
+            # found the less relevant results are not, the more relevant
+            # ones still are
+            rank = rq.rank if confident is not None else None
+            ans = []
+            for job in workers:
+                w = getattr(job, 'worker', job)
+                if rank is not None and w.relevance > rank:
+                    if job.is_alive() and w not in skipped:
+                        skipped.add(w)
+                        w.cancel.set()
+                elif job.is_alive():
+                    ans.append(job)
+            return ans
 
         while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
-                    break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
+            alive = pending()
+            if not alive:
                 break
+            alive[0].join(0.2)
+
+        if confident is not None and not abort.is_set():
+            if confident.is_set():
+                log('Found a confident match at position %d, skipped %d less'
+                        ' relevant results' % (rq.rank + 1, len(skipped)))
+            self.editions_limit.record(rq.rank)
 
+        if self.prefs['connection_pool']:
+            from calibre_plugins.AMAZON_CN.connection import get_pool
+            log.debug('Connection pool: %r' % get_pool().counters())
+        # Not "no match" if no details page could be downloaded
+        errors = [getattr(w, 'worker', w).error for w in workers]
+        if workers and not fast_results and not abort.is_set() and all(errors):
+            return as_unicode(errors[0])
         return None
     # }}}
 
+    def identify_by_asin(self, log, result_queue, abort, asin, timeout=30):  # {{{
+        '''
+        Download the details page for asin directly, without a search.
+        Returns the Worker used: its not_found is True if Amazon has no
+        details page for asin, in which case a search should be made instead,
+        and its error is set if the download failed.
+        '''
+        from calibre_plugins.AMAZON_CN.worker import Worker
+        url = self.get_book_url({'amazon_cn': asin})[2]
+        w = Worker(url, result_queue, self.browser, log, 0, self,
+                timeout=timeout, testing=getattr(self, 'running_a_test', False),
+                clone_browser=False, cancel=abort, aborted=abort)
+        page = [w.fetch()]
+        if page[0] is not None and not abort.is_set():
+            w.process(page)
+        return w
+    # }}}
+
+    def identify_many(self, log, books, abort, timeout=30, concurrency=None):  # {{{
+        '''
+        Identify many books at once. books is a list of dicts with the
+        title, authors and identifiers keyword arguments of identify().
+        Yields (index, results, error) for every book, in the order the
+        lookups complete, where results is the list of Metadata objects found
+        and error the reason the lookup failed, None if it did not. No results
+        without an error means Amazon has no match for the book.
+
+        Books that resolve to the same lookup (same ASIN, ISBN or title and
+        authors) are looked up only once and share the same results. Books
+        with a known ASIN skip the search page. All lookups share the
+        scheduler and download engine of the plugin. At most concurrency
+        (max_concurrent_fetches by default) lookups run at the same time. No
+        new lookups are started while the circuit breaker of the scheduler is
+        open, as they would all fail.
+        '''
+        lookups = {}
+        for i, book in enumerate(books):
+            identifiers = book.get('identifiers', None) or {}
+            asin = self.get_cached_asin(identifiers)
+            isbn = check_isbn(identifiers.get('isbn', None))
+            if asin is not None:
+                key = ('asin', asin)
+            elif isbn is not None:
+                key = ('isbn', isbn)
+            else:
+                key = ('query', book.get('title', None),
+                        tuple(book.get('authors', None) or ()))
+            lookups.setdefault(key, (book, []))[1].append(i)
+
+        tasks, done = Queue(), Queue()
+        for key, (book, indices) in lookups.iteritems():
+            tasks.put((key, book, indices))
+
+        def run():
+            while not abort.is_set():
+                delay = self.scheduler.closed_in()
+                if delay > 0:
+                    # Wait for Amazon to stop limiting requests
+                    abort.wait(min(delay, 1))
+                    continue
+                try:
+                    key, book, indices = tasks.get_nowait()
+                except Empty:
+                    break
+                rq = Queue()
+                try:
+                    error = self.identify(log, rq, abort,
+                            title=book.get('title', None),
+                            authors=book.get('authors', None),
+                            identifiers=book.get('identifiers', None) or {},
+                            timeout=timeout)
+                except Exception as e:
+                    log.exception('Failed to identify: %r' % (key,))
+                    error = as_unicode(e)
+                results = []
+                while True:
+                    try:
+                        results.append(rq.get_nowait())
+                    except Empty:
+                        break
+                done.put((indices, results, error))
+
+        self.start_parse_pool(log)
+        runners = []
+        if concurrency is None:
+            concurrency = self.prefs['max_concurrent_fetches']
+        for i in xrange(min(len(lookups), max(1, int(concurrency)))):
+            t = Thread(target=run, name='AmazonCNBatch%d' % i)
+            t.daemon = True
+            t.start()
+            runners.append(t)
+
+        remaining = len(lookups)
+        while remaining and not abort.is_set():
+            try:
+                indices, results, error = done.get(timeout=0.2)
+            except Empty:
+                if not any(t.is_alive() for t in runners) and done.empty():
+                    break
+                continue
+            remaining -= 1
+            for i in indices:
+                yield i, results, error
+    # }}}
+
     def download_cover(self, log, result_queue, abort,
             title=None, authors=None, identifiers={}, timeout=30,
             get_best_cover=False):  # {{{
+        from calibre_plugins.AMAZON_CN.cancel import following
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        try:
+            with following(abort) as abort, metrics.timer('download_cover'):
+                self._download_cover(log, result_queue, abort, title=title,
+                        authors=authors, identifiers=identifiers,
+                        timeout=timeout, get_best_cover=get_best_cover)
+        finally:
+            self.log_cache_errors(log)
+            self.dump_metrics(log)
+
+    def _download_cover(self, log, result_queue, abort,
+            title=None, authors=None, identifiers={}, timeout=30,
+            get_best_cover=False):
+        '''
+        abort is a Cancel, see download_cover().
+        '''
+        from calibre_plugins.AMAZON_CN.cancel import Cancelled, scope
+        from calibre_plugins.AMAZON_CN.flight import get_flight
+        from calibre_plugins.AMAZON_CN.metrics import metrics
         cached_url = self.get_cached_cover_url(identifiers)
-        if cached_url is None:
+        asin = self.get_cached_asin(identifiers)
+        # The best cover is found from the ASIN alone
+        best = get_best_cover and asin is not None
+        if cached_url is None and not best:
             log.info('No cached cover found, running identify')
             rq = Queue()
             self.identify(log, rq, abort, title=title, authors=authors,
@@ -329,21 +1116,129 @@ class Amazon_CN(Source):
             for mi in results:
                 cached_url = self.get_cached_cover_url(mi.identifiers)
                 if cached_url is not None:
+                    asin = self.get_cached_asin(mi.identifiers)
                     break
-        if cached_url is None:
+        if cached_url is None and not best:
             log.info('No cover found')
             return
 
         if abort.is_set():
             return
         br = self.browser
+        # Concurrent downloads of the same cover share one fetch
+        flight = get_flight('cover')
+        if get_best_cover and asin is not None:
+            try:
+                with scope(abort):
+                    cdata = flight.do(('best', asin),
+                            lambda: self.download_best_cover(log, asin,
+                                cached_url, br, timeout=timeout, cancel=abort))
+            except Cancelled:
+                return
+            except:
+                if abort.is_set():
+                    return
+                log.exception('Failed to download best cover for:', asin)
+                cdata = None
+            if cdata:
+                result_queue.put((self, cdata))
+                return
+            if cached_url is None:
+                log.info('No cover found')
+                return
+        if asin is not None:
+            # Reuse the bytes already fetched when probing for the cover
+            try:
+                with scope(abort):
+                    url, cdata = flight.do(('probe', asin),
+                            lambda: self.cover_probes.fetch(asin, br, log,
+                                timeout=timeout, scheduler=self.scheduler))
+            except Cancelled:
+                return
+            except:
+                if abort.is_set():
+                    return
+                log.exception('Failed to download probed cover for:', asin)
+                url = cdata = None
+            if cdata:
+                log('Downloaded cover from:', url)
+                result_queue.put((self, cdata))
+                return
         log('Downloading cover from:', cached_url)
+
+        def fetch():
+            with self.scheduler.slot(), metrics.timer('fetch.cover'):
+                cdata = br.open_novisit(cached_url, timeout=timeout).read()
+            metrics.count('bytes', 'cover', len(cdata))
+            return cdata
+
+        if abort.is_set():
+            return
         try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
+            with scope(abort):
+                cdata = flight.do(cached_url, fetch)
             if cdata:
                 result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
+        except Exception as e:
+            from calibre_plugins.AMAZON_CN.scheduler import is_throttle_error
+            if isinstance(e, Cancelled) or abort.is_set():
+                return
+            if is_throttle_error(e):
+                log.error('Amazon.cn is limiting requests, not downloading'
+                        ' cover from:', cached_url)
+            else:
+                log.exception('Failed to download cover from:', cached_url)
+    # }}}
+
+    def cache_best_cover_url(self, asin, url):
+        with self.cache_lock:
+            self._best_cover_urls[asin] = url
+        self._cache_set('best_cover', asin, url.encode('utf-8'))
+
+    def cached_best_cover_url(self, asin):
+        with self.cache_lock:
+            ans = self._best_cover_urls.get(asin, None)
+        if ans is None:
+            ans = self._cache_get('best_cover', asin)
+            if ans is not None:
+                ans = ans.decode('utf-8')
+                with self.cache_lock:
+                    self._best_cover_urls[asin] = ans
+        return ans
+
+    def download_best_cover(self, log, asin, known_url, br, timeout=30,
+            cancel=None):  # {{{
+        '''
+        Download the biggest cover Amazon has for asin. The dimensions of
+        every size Amazon may have, and of known_url, are read from the first
+        few KB of each, in parallel, and only the biggest is downloaded
+        completely. The url found is remembered, later calls download it
+        straight away.
+        '''
+        from calibre_plugins.AMAZON_CN.cover import (best_cover,
+                cover_variants, fetch_rest)
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        url = self.cached_best_cover_url(asin)
+        if url is not None:
+            log('Downloading best cover remembered for %s from: %s' % (asin, url))
+            with self.scheduler.slot(), metrics.timer('fetch.cover'):
+                cdata = br.open_novisit(url, timeout=timeout).read()
+            metrics.count('bytes', 'cover', len(cdata))
+            return cdata
+        urls = cover_variants(asin)
+        if known_url and known_url not in urls:
+            urls.append(known_url)
+        with metrics.timer('cover_best'):
+            best = best_cover(urls, br, log, timeout=timeout,
+                    scheduler=self.scheduler, cancel=cancel)
+        if best is None:
+            log('No cover found among the sizes Amazon has for:', asin)
+            return None
+        url, width, height, data, complete = best
+        self.cache_best_cover_url(asin, url)
+        log('Downloading %dx%d cover from: %s' % (width, height, url))
+        return fetch_rest(br, url, data, complete, timeout=timeout,
+                scheduler=self.scheduler)
     # }}}
 
 if __name__ == '__main__':  # tests {{{
@@ -0,0 +1,806 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Offline benchmarks for the plugin. To run them use:
+#   calibre-debug -e bench.py -- run [--save-baseline] [--tolerance=0.25]
+#   calibre-debug -e bench.py -- comments|parse|identify|memory|results|scaling|selectors [page.html ...]
+#   calibre-debug -e bench.py -- validate [page.html ...]
+#
+# The pages in fixtures/ cover each generation of the amazon.cn search and
+# details page markup the plugin understands. They are served by a local
+# HTTP server standing in for amazon.cn, so no request leaves the machine.
+# The small pages hold just the markup the plugin reads. The *_full pages
+# wrap the same markup in the scripts, styles, navigation and other page
+# furniture of a real page, at the size of a real page, so that the timings
+# and memory figures measured on them are representative.
+# "run" runs every benchmark and compares the results to
+# fixtures/baseline.json, failing if any of them regressed by more than the
+# tolerance, or if there is no baseline. The baseline depends on the
+# machine, save one with --save-baseline before making changes. Pages saved
+# by the tests in __init__.py can be added to the corpus as
+# search_<name>.html or details_<name>.html. "validate" checks that the
+# streaming search results extractor finds the same links as the DOM based
+# parse_results_page() on every search page, and that descriptions are
+# rendered to the same HTML as by the old regular expression pipeline. It
+# also checks that aborting identify while details pages are downloading
+# makes it return promptly, with no requests made after the abort.
+
+import os, re, sys, time, glob, json
+from threading import Lock, Thread, Event
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINE = os.path.join(FIXTURES, 'baseline.json')
+
+def fixture_pages(kind):
+    return sorted(glob.glob(os.path.join(FIXTURES, kind + '_*.html')))
+
+def fixture_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def peak_memory():
+    '''
+    Peak resident set size of this process in KB, None where unknown.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    ans = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return ans // 1024 if sys.platform == 'darwin' else ans
+
+def timed(func, repeat):
+    best = None
+    for i in xrange(repeat):
+        st = time.time()
+        func()
+        t = time.time() - st
+        best = t if best is None else min(best, t)
+    return best
+
+# Stand-in for amazon.cn {{{
+class FixtureHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.requests.append(self.path)
+            srv.arrivals.append((time.time(), self.path))
+        path = None
+        if self.path.startswith('/s/'):
+            path = srv.search_page
+        else:
+            m = re.search(r'/dp/([A-Z0-9]{10})', self.path)
+            if m is not None:
+                path = srv.details.get(m.group(1), None)
+                if srv.delay:
+                    time.sleep(srv.delay)
+        etag = None
+        if path is None:
+            data = b'<html><head><title>404 - Document Not Found</title></head></html>'
+            self.send_response(404)
+        else:
+            import hashlib
+            with open(path, 'rb') as f:
+                data = f.read()
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                data = b''
+                self.send_response(304)
+            else:
+                self.send_response(200)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+
+    '''
+    Serves the fixture pages on localhost: search urls get search_page and
+    /dp/<ASIN> urls get the details fixture whose canonical link has that
+    ASIN, with an ETag, answering conditional requests for unchanged pages
+    with a 304, after delay seconds. Every other url is a 404. The paths of
+    all requests received are recorded in requests, with the time they
+    arrived in arrivals.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FixtureHandler)
+        self.lock = Lock()
+        self.requests = []
+        self.arrivals = []
+        self.delay = 0
+        self.search_page = None
+        self.details = {}
+        for path in fixture_pages('details'):
+            with open(path, 'rb') as f:
+                m = re.search(br'<link rel="canonical" href="[^"]+/dp/([A-Z0-9]{10})"', f.read())
+            if m is not None:
+                self.details[m.group(1).decode('ascii')] = path
+        t = Thread(target=self.serve_forever, name='FixtureServer')
+        t.daemon = True
+        t.start()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients that went away, such as aborted lookups
+        pass
+
+def offline_plugin(server, **prefs):
+    '''
+    An instance of the plugin that sends all its requests to server and uses
+    the default settings, updated with prefs, instead of the user's.
+    '''
+    from calibre_plugins.AMAZON_CN import Amazon_CN
+    from calibre_plugins.AMAZON_CN.connection import (ConnectionPool,
+            PooledBrowser)
+
+    class OfflineBrowser(PooledBrowser):
+
+        def open_novisit(self, url_or_request, timeout=None):
+            if hasattr(url_or_request, 'get_full_url'):
+                from urllib2 import Request
+                url_or_request = Request(self.rewrite(url_or_request.get_full_url()),
+                        headers=dict(url_or_request.header_items()))
+            else:
+                url_or_request = self.rewrite(url_or_request)
+            return PooledBrowser.open_novisit(self, url_or_request,
+                    timeout=timeout)
+
+        def rewrite(self, url):
+            return re.sub(r'^https?:/+[^/]+', server.base_url, url)
+
+    pool = ConnectionPool()
+
+    class OfflineAmazon_CN(Amazon_CN):
+
+        def __init__(self):
+            Amazon_CN.__init__(self, None)
+            self._offline_prefs = dict((o.name, o.default) for o in self.options)
+            self._offline_prefs['persistent_cache'] = False
+            self._offline_prefs['response_cache'] = False
+            self._offline_prefs.update(prefs)
+
+        @property
+        def prefs(self):
+            return self._offline_prefs
+
+        @property
+        def browser(self):
+            br = OfflineBrowser(pool, [('User-Agent', 'calibre benchmark')],
+                    proxies={})
+            cache = self.response_cache
+            if cache is not None:
+                from calibre_plugins.AMAZON_CN.connection import CachingBrowser
+                br = CachingBrowser(br, cache, on_error=self.cache_failed)
+            return br
+
+    return OfflineAmazon_CN()
+# }}}
+
+def load_page(path):
+    from calibre.ebooks.chardet import xml_to_unicode
+    from calibre.utils.cleantext import clean_ascii_chars
+    from calibre_plugins.AMAZON_CN.parsing import parse_lxml
+    with open(path, 'rb') as f:
+        raw = f.read()
+    raw = clean_ascii_chars(xml_to_unicode(raw, strip_encoding_pats=True,
+        resolve_entities=True)[0])
+    return parse_lxml(raw)
+
+def bench_selectors(paths=None, repeat=20):  # {{{
+    '''
+    Compare evaluating every selector of the plugin against a page when the
+    selectors are compiled once (the registry in xpaths) and when they are
+    compiled on every use (what the plugin used to do).
+    '''
+    from lxml.etree import XPath
+    from cssselect import HTMLTranslator
+    from calibre_plugins.AMAZON_CN import xpaths
+
+    selectors = xpaths.registry().values()
+
+    def compiled(root):
+        for x in selectors:
+            x(root)
+
+    def uncompiled(root):
+        for x in selectors:
+            src = xpaths.css_sources.get(x.path, None)
+            if src is None:
+                root.xpath(x.path)
+            else:
+                XPath(HTMLTranslator().css_to_xpath(src))(root)
+
+    ans = {}
+    for path in paths or fixture_pages('*'):
+        root = load_page(path)
+        old = timed(lambda: uncompiled(root), repeat)
+        new = timed(lambda: compiled(root), repeat)
+        print('%s: %d selectors, compiled on use: %.2fms, precompiled: %.2fms,'
+              ' saving %.2fms per page' % (fixture_name(path), len(selectors),
+                  old * 1000, new * 1000, (old - new) * 1000))
+        ans['selectors.' + fixture_name(path)] = new
+    return ans
+# }}}
+
+def bench_parse(paths=None, repeat=10):  # {{{
+    '''
+    Time decoding, parsing and every field extractor on each page, and the
+    overall number of pages processed per second.
+    '''
+    from Queue import Queue
+    from calibre.ebooks.chardet import xml_to_unicode
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ebooks.metadata.sources.base import create_log
+    from calibre.utils.cleantext import clean_ascii_chars
+    from calibre_plugins.AMAZON_CN import xpaths
+    from calibre_plugins.AMAZON_CN.parsing import parse_html, DETAILS_PAGE_REQUIRED
+    from calibre_plugins.AMAZON_CN.worker import Worker
+
+    server = FixtureServer()
+    plugin = offline_plugin(server)
+    log = create_log()
+
+    def details(w, root):
+        mi = Metadata('', [])
+        non_hero = xpaths.non_hero(root)
+        if non_hero:
+            w.parse_new_details(root, mi, non_hero[0])
+        else:
+            pd = xpaths.product_details(root)
+            if pd:
+                w.parse_isbn(pd[0]), w.parse_publisher(pd[0])
+                w.parse_pubdate(pd[0]), w.parse_language(pd[0])
+
+    fields = (
+        ('asin', lambda w, root, raw: w.parse_asin(root)),
+        ('title', lambda w, root, raw: w.parse_title(root)),
+        ('authors', lambda w, root, raw: w.parse_authors(root)),
+        ('rating', lambda w, root, raw: w.parse_rating(root)),
+        ('comments', lambda w, root, raw: w.parse_comments(root)),
+        ('series', lambda w, root, raw: w.parse_series(root)),
+        ('tags', lambda w, root, raw: w.parse_tags(root)),
+        ('cover', lambda w, root, raw: w.parse_cover(root, raw)),
+        ('details', lambda w, root, raw: details(w, root)),
+    )
+
+    ans = {}
+    start_mem = peak_memory()
+    pages, total = 0, 0.0
+    for path in paths or fixture_pages('details'):
+        name = fixture_name(path)
+        with open(path, 'rb') as f:
+            raw = f.read()
+        times = dict((k, []) for k in ('decode', 'parse') + tuple(x[0] for x in fields))
+        for i in xrange(repeat):
+            st = time.time()
+            text = clean_ascii_chars(xml_to_unicode(raw,
+                strip_encoding_pats=True, resolve_entities=True)[0])
+            times['decode'].append(time.time() - st)
+            t = time.time()
+            root = parse_html(text, required=DETAILS_PAGE_REQUIRED)
+            times['parse'].append(time.time() - t)
+            w = Worker('http://www.amazon.cn/', Queue(), plugin.browser, log,
+                    0, plugin, clone_browser=False)
+            w.amazon_id = w.parse_asin(root)
+            for field, func in fields:
+                t = time.time()
+                try:
+                    func(w, root, raw)
+                except Exception:
+                    log.exception('Failed to parse %s from %s' % (field, name))
+                times[field].append(time.time() - t)
+            total += time.time() - st
+            pages += 1
+        for k, v in times.iteritems():
+            ans['field.%s.%s' % (name, k)] = min(v)
+        print('%s: %s' % (name, ', '.join('%s %.2fms' % (k, min(times[k]) * 1000)
+            for k in ('decode', 'parse') + tuple(x[0] for x in fields))))
+    ans['pages_per_sec'] = pages / total if total else 0
+    end_mem = peak_memory()
+    if end_mem is not None:
+        ans['peak_memory_kb'] = end_mem
+        print('Peak memory: %d KB (%+d KB while parsing)' % (end_mem,
+            end_mem - start_mem))
+    print('Pages per second: %.1f' % ans['pages_per_sec'])
+    server.shutdown()
+    server.server_close()
+    return ans
+# }}}
+
+def bench_identify(paths=None, repeat=5):  # {{{
+    '''
+    Time complete identify calls, from the search to the last details page,
+    against the local stand-in for amazon.cn.
+    '''
+    from Queue import Queue, Empty
+    from calibre.ebooks.metadata.sources.base import create_log
+
+    server = FixtureServer()
+    plugin = offline_plugin(server)
+    ans = {}
+    for path in paths or fixture_pages('search'):
+        name = fixture_name(path)
+        server.search_page = path
+        found = []
+
+        def run():
+            rq = Queue()
+            plugin.identify(create_log(), rq, Event(), title='第七天',
+                    authors=['余华'], timeout=10)
+            found[:] = []
+            while True:
+                try:
+                    found.append(rq.get_nowait())
+                except Empty:
+                    break
+
+        t = timed(run, repeat)
+        ans['identify.' + name] = t
+        print('%s: identify took %.1fms, %d results' % (name, t * 1000,
+            len(found)))
+    server.shutdown()
+    server.server_close()
+    return ans
+# }}}
+
+def validate(paths=None):  # {{{
+    '''
+    Return the pages on which the fast extractors disagree with the ones they
+    replaced.
+    '''
+    if paths:
+        search = [x for x in paths if fixture_name(x).startswith('search')]
+        details = [x for x in paths if x not in search]
+    else:
+        search, details = fixture_pages('search'), fixture_pages('details')
+    return (validate_results(search) + validate_comments(details) +
+            validate_cancel(search))
+
+def validate_results(paths):
+    '''
+    Return the search pages on which stream_results_page() and
+    parse_results_page() disagree, with the links each of them found.
+    '''
+    from calibre_plugins.AMAZON_CN.parsing import stream_results_page
+
+    server = FixtureServer()
+    plugin = offline_plugin(server)
+    mismatches = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        dom = plugin.parse_results_page(load_page(path))
+        stream = list(stream_results_page(raw, plugin.MAX_EDITIONS))
+        if dom != stream:
+            mismatches.append((fixture_name(path), dom, stream))
+        print('%s: %s (%d links)' % (fixture_name(path),
+            'OK' if dom == stream else 'MISMATCH', len(dom)))
+    for name, dom, stream in mismatches:
+        print('\n%s\n\tparse_results_page: %r\n\tstream_results_page: %r' % (
+            name, dom, stream))
+    server.shutdown()
+    server.server_close()
+    return mismatches
+# }}}
+
+def validate_cancel(paths, delay=2):
+    '''
+    Abort identify as soon as it starts downloading details pages, that the
+    server takes delay seconds to send, and return the problems found: it not
+    returning promptly, or requests being made after the abort.
+    '''
+    from Queue import Queue
+    from calibre.ebooks.metadata.sources.base import create_log
+
+    server = FixtureServer()
+    server.delay = delay
+    problems = []
+    for path in paths[:1]:
+        name = fixture_name(path)
+        server.search_page = path
+        with server.lock:
+            del server.requests[:], server.arrivals[:]
+        plugin = offline_plugin(server)
+        abort = Event()
+        t = Thread(target=plugin.identify, args=(create_log(), Queue(), abort),
+                kwargs={'title': '第七天', 'authors': ['余华'], 'timeout': 30})
+        t.daemon = True
+        t.start()
+        end = time.time() + 10
+        while time.time() < end and not any('/dp/' in x for x in server.requests):
+            time.sleep(0.01)
+        st = time.time()
+        abort.set()
+        t.join(delay)
+        took = time.time() - st
+        if t.is_alive() or took >= delay:
+            problems.append((name, 'identify returned %.1fs after the abort' % took))
+        # Give requests made after the abort time to arrive
+        time.sleep(delay)
+        with server.lock:
+            made = len([x for x in server.arrivals if x[0] <= st])
+            late = [p for at, p in server.arrivals if at > st]
+        if late:
+            problems.append((name, 'requests made after the abort: %r' % late))
+        print('%s: %s (aborted after %d requests, returned in %.0fms)' % (name,
+            'FAILED' if problems else 'OK', made, took * 1000))
+    for name, problem in problems:
+        print('\n%s\n\t%s' % (name, problem))
+    server.shutdown()
+    server.server_close()
+    return problems
+
+def render_comments_reference(desc):
+    '''
+    The HTML the plugin used to give sanitize_comments_html, made by removing
+    nodes from desc, serializing it and cleaning up the result with regular
+    expressions. Modifies desc.
+    '''
+    from lxml.html import tostring
+    from calibre_plugins.AMAZON_CN import xpaths
+    for c in xpaths.comments_noscripts(desc):
+        c.getparent().remove(c)
+    for c in xpaths.comments_junk(desc):
+        c.getparent().remove(c)
+    for a in xpaths.comments_links(desc):
+        del a.attrib['href']
+        a.tag = 'span'
+    desc = tostring(desc, method='html', encoding=unicode).strip()
+    desc = desc.replace('\ufffd', "'")
+    desc = re.sub(r'<([a-zA-Z0-9]+)\s[^>]+>', r'<\1>', desc)
+    desc = re.sub(r'(?s)<em>--This text ref.*?</em>', '', desc)
+    desc = re.sub(r'(?s)<!--.*?-->', '', desc)
+    return desc
+
+def descriptions(root):
+    '''
+    The description elements Worker.parse_comments() renders.
+    '''
+    import html5lib
+    from calibre_plugins.AMAZON_CN import xpaths
+    ans = []
+    for ns in xpaths.comments_noscript(root)[:1]:
+        if len(ns) == 0 and ns.text:
+            ns = html5lib.parseFragment('<div>%s</div>' % (ns.text),
+                    treebuilder='lxml', namespaceHTMLElements=False)[0]
+        else:
+            ns.tag = 'div'
+        ans.append(ns)
+    for x in (xpaths.comments_ps_content, xpaths.comments_product_description):
+        ans.extend(x(root)[:1])
+    return ans
+
+def validate_comments(paths):
+    '''
+    Return the descriptions in the details pages for which render_comments()
+    and the old pipeline give different HTML.
+    '''
+    from copy import deepcopy
+    from calibre_plugins.AMAZON_CN.comments import render_comments
+
+    mismatches = []
+    for path in paths:
+        name = fixture_name(path)
+        descs = descriptions(load_page(path))
+        bad = 0
+        for i, desc in enumerate(descs):
+            new = render_comments(deepcopy(desc))
+            old = render_comments_reference(deepcopy(desc))
+            if new != old:
+                bad += 1
+                mismatches.append(('%s description %d' % (name, i), old, new))
+        print('%s: %s (%d descriptions)' % (name, 'MISMATCH' if bad else 'OK',
+            len(descs)))
+    for name, old, new in mismatches:
+        print('\n%s\n\told pipeline: %r\n\trender_comments: %r' % (
+            name, old, new))
+    return mismatches
+
+def bench_comments(paths=None, repeat=10, copies=200):  # {{{
+    '''
+    Time rendering long descriptions, made of copies copies of the ones in
+    the details pages, with render_comments() and with the old pipeline, and
+    the sanitize_comments_html() both are followed by. Single descriptions
+    are timed too, as the fixed cost of each pass matters most for them.
+    '''
+    from copy import deepcopy
+    from lxml.html import Element
+    from calibre.library.comments import sanitize_comments_html
+    from calibre_plugins.AMAZON_CN.comments import render_comments
+
+    ans = {}
+    for path in paths or fixture_pages('details'):
+        name = fixture_name(path)
+        descs = descriptions(load_page(path))
+        if not descs:
+            continue
+        desc = Element('div')
+        for i in xrange(copies):
+            for d in descs:
+                desc.append(deepcopy(d))
+        # Both modify the tree, give every run its own copy
+        trees = [deepcopy(desc) for i in xrange(2 * repeat)]
+        old = timed(lambda: render_comments_reference(trees.pop()), repeat)
+        new = timed(lambda: render_comments(trees.pop()), repeat)
+        html = render_comments(desc)
+        sanitize = timed(lambda: sanitize_comments_html(html), max(1, repeat // 5))
+        trees = [deepcopy(descs[0]) for i in xrange(200)]
+        old1 = timed(lambda: render_comments_reference(trees.pop()), 100)
+        new1 = timed(lambda: render_comments(trees.pop()), 100)
+        print('%s: %d KB of HTML, old pipeline: %.2fms, render_comments:'
+              ' %.2fms (%.1fx faster), sanitize_comments_html: %.2fms;'
+              ' one description: %.3fms, %.3fms (%.1fx faster)' % (
+                  name, len(html) // 1024, old * 1000, new * 1000,
+                  old / new if new else 0, sanitize * 1000, old1 * 1000,
+                  new1 * 1000, old1 / new1 if new1 else 0))
+        ans['comments.' + name] = new
+    return ans
+# }}}
+
+def bench_results(paths=None, repeat=20):  # {{{
+    '''
+    Compare finding the links on search pages by decoding and parsing the
+    whole page with getting them from the streaming extractor, and how soon
+    the streaming extractor finds the first one.
+    '''
+    from calibre.ebooks.chardet import xml_to_unicode
+    from calibre.utils.cleantext import clean_ascii_chars
+    from calibre_plugins.AMAZON_CN.parsing import (parse_html,
+            stream_results_page, RESULTS_PAGE_REQUIRED)
+
+    server = FixtureServer()
+    plugin = offline_plugin(server)
+
+    def dom(raw):
+        text = clean_ascii_chars(xml_to_unicode(raw,
+            strip_encoding_pats=True, resolve_entities=True)[0])
+        plugin.parse_results_page(parse_html(text, required=RESULTS_PAGE_REQUIRED))
+
+    ans = {}
+    for path in paths or fixture_pages('search'):
+        name = fixture_name(path)
+        with open(path, 'rb') as f:
+            raw = f.read()
+        old = timed(lambda: dom(raw), repeat)
+        new = timed(lambda: list(stream_results_page(raw,
+            plugin.MAX_EDITIONS)), repeat)
+        first = timed(lambda: next(stream_results_page(raw,
+            plugin.MAX_EDITIONS), None), repeat)
+        print('%s: decode and parse: %.2fms, streaming: %.2fms, %.1fx faster,'
+                ' first link after %.2fms' % (name, old * 1000, new * 1000,
+                    old / new if new else 0, first * 1000))
+        ans['results.' + name] = new
+    server.shutdown()
+    server.server_close()
+    return ans
+# }}}
+
+def peak_memory_growth(func):
+    '''
+    Run func in a forked child process and return how much it grew the peak
+    resident set size, in KB. None where fork() is not available.
+    '''
+    if not hasattr(os, 'fork') or peak_memory() is None:
+        return None
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            before = peak_memory()
+            func()
+            os.write(w, str(peak_memory() - before).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        ans = f.read()
+    os.waitpid(pid, 0)
+    return int(ans) if ans else None
+
+def bench_memory(paths=None, copies=25):  # {{{
+    '''
+    Peak memory used to hold the parsed trees of copies details pages at the
+    same time, as happens when many workers are running, when the complete
+    page is parsed and when only the parts the extractors need are kept.
+    '''
+    from calibre.ebooks.chardet import xml_to_unicode
+    from calibre.utils.cleantext import clean_ascii_chars
+    from calibre_plugins.AMAZON_CN.parsing import (parse_html,
+            parse_details_partial, DETAILS_PAGE_REQUIRED)
+
+    def full(text):
+        return parse_html(text, required=DETAILS_PAGE_REQUIRED)
+
+    def partial(text):
+        return parse_details_partial(text, required=DETAILS_PAGE_REQUIRED)
+
+    ans = {}
+    for path in paths or fixture_pages('details'):
+        name = fixture_name(path)
+        with open(path, 'rb') as f:
+            raw = f.read()
+        # Import everything used before measuring
+        text = clean_ascii_chars(xml_to_unicode(raw,
+            strip_encoding_pats=True, resolve_entities=True)[0])
+        full(text), partial(text)
+        results = []
+        for mode, parse in (('full', full), ('partial', partial)):
+            def run():
+                trees = []
+                for i in xrange(copies):
+                    text = clean_ascii_chars(xml_to_unicode(raw,
+                        strip_encoding_pats=True, resolve_entities=True)[0])
+                    trees.append(parse(text))
+                    del text
+            kb = peak_memory_growth(run)
+            if kb is None:
+                print('Measuring memory use is not supported on this platform')
+                return ans
+            ans['memory.%s.%s_kb' % (name, mode)] = kb
+            results.append(kb)
+        print('%s: %d pages (%d KB each) held at once, peak memory: full tree:'
+              ' %d KB, partial tree: %d KB' % (name, copies, len(raw) // 1024,
+                  results[0], results[1]))
+    return ans
+# }}}
+
+def bench_scaling(paths=None, pages=200):  # {{{
+    '''
+    Details pages parsed per second by n threads parsing in this process and
+    by n threads each keeping one of n parser processes busy, for n up to the
+    number of CPU cores.
+    '''
+    import multiprocessing
+    from Queue import Queue, Empty
+    from calibre.ebooks.metadata.sources.base import create_log
+    from calibre_plugins.AMAZON_CN.parsepool import (get_parse_pool,
+            shutdown_parse_pools)
+    from calibre_plugins.AMAZON_CN.worker import Worker
+
+    if not hasattr(os, 'fork'):
+        print('Parser processes are not supported on this platform')
+        return {}
+    server = FixtureServer()
+    plugin = offline_plugin(server)
+    raws = []
+    for path in paths or fixture_pages('details'):
+        with open(path, 'rb') as f:
+            raws.append(f.read())
+    cores = multiprocessing.cpu_count()
+    counts = sorted(set(n for n in (1, 2, 4, 8, cores) if n <= cores))
+
+    def parse(nthreads, pool):
+        todo = Queue()
+        for i in xrange(pages):
+            todo.put(raws[i % len(raws)])
+        log = create_log()
+
+        def run():
+            while True:
+                try:
+                    raw = todo.get_nowait()
+                except Empty:
+                    break
+                w = Worker('http://www.amazon.cn/', Queue(), plugin.browser,
+                        log, 0, plugin, clone_browser=False)
+                if pool is None:
+                    w.parse_page([raw])
+                else:
+                    pool.parse(w, raw)
+
+        threads = [Thread(target=run) for i in xrange(nthreads)]
+        st = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return pages / (time.time() - st)
+
+    ans = {}
+    for n in counts:
+        pool = get_parse_pool(n)
+        threads, processes = parse(n, None), parse(n, pool)
+        ans['scaling.threads_%d.pages_per_sec' % n] = threads
+        ans['scaling.processes_%d.pages_per_sec' % n] = processes
+        print('%d cores: %d threads: %.1f pages/sec, %d processes: %.1f pages/sec' % (
+            n, n, threads, n, processes))
+    shutdown_parse_pools()
+    server.shutdown()
+    server.server_close()
+    return ans
+# }}}
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the names of the results that are worse than baseline by more
+    than tolerance (a fraction). Rates are better when higher, everything
+    else when lower.
+    '''
+    failures = []
+    for key, val in sorted(results.iteritems()):
+        base = baseline.get(key, None)
+        if not base:
+            continue
+        ratio = val / base
+        if key.endswith('_per_sec'):
+            bad = ratio < 1 - tolerance
+        else:
+            bad = ratio > 1 + tolerance
+        if bad:
+            failures.append('%s: %.4g (baseline: %.4g)' % (key, val, base))
+    return failures
+
+def run(save_baseline=False, tolerance=0.25):
+    if validate():
+        print('\nThe fast extractors do not give the same results as the'
+                ' ones they replaced')
+        return 1
+    results = {}
+    for func in (bench_selectors, bench_parse, bench_memory, bench_scaling,
+            bench_results, bench_comments, bench_identify):
+        print('\n%s' % func.__name__)
+        results.update(func())
+    if save_baseline:
+        with open(BASELINE, 'wb') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True).encode('utf-8'))
+        print('\nBaseline saved to', BASELINE)
+        return 0
+    if not os.path.exists(BASELINE):
+        print('\nNo baseline to compare with, create one with --save-baseline')
+        return 1
+    with open(BASELINE, 'rb') as f:
+        baseline = json.loads(f.read())
+    failures = compare(results, baseline, tolerance)
+    if failures:
+        print('\nRegressions (tolerance: %d%%):' % (tolerance * 100))
+        for x in failures:
+            print('\t' + x)
+        return 1
+    print('\nNo regressions')
+    return 0
+
+def main(args=sys.argv):
+    benchmarks = {'selectors': bench_selectors, 'parse': bench_parse,
+            'identify': bench_identify, 'results': bench_results,
+            'memory': bench_memory, 'scaling': bench_scaling,
+            'comments': bench_comments}
+    if len(args) > 1 and args[1] == 'run':
+        tolerance = 0.25
+        for x in args[2:]:
+            if x.startswith('--tolerance='):
+                tolerance = float(x.partition('=')[-1])
+        return run(save_baseline='--save-baseline' in args, tolerance=tolerance)
+    if len(args) > 1 and args[1] == 'validate':
+        return 1 if validate(args[2:] or None) else 0
+    if len(args) < 2 or args[1] not in benchmarks:
+        print('Usage: calibre-debug -e bench.py -- run|validate|%s [page.html ...]' %
+                '|'.join(sorted(benchmarks)))
+        return 1
+    benchmarks[args[1]](args[2:] or None)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
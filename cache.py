@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, time, zlib, sqlite3
+from threading import Lock
+
+def cache_path(name='amazon_cn.sqlite'):
+    try:
+        from calibre.constants import cache_dir
+        base = cache_dir()
+    except ImportError:
+        from calibre.constants import config_dir as base
+    base = os.path.join(base, 'metadata-sources')
+    if not os.path.exists(base):
+        try:
+            os.makedirs(base)
+        except EnvironmentError:
+            pass
+    return os.path.join(base, name)
+
+def normalize_query_url(url):
+    '''
+    The key under which the results of the search url are remembered: the
+    same for urls that differ only in the order, case or spacing of their
+    query parameters.
+    '''
+    from urlparse import urlsplit, parse_qsl
+    from urllib import urlencode
+    parts = urlsplit(url)
+    q = sorted((k, ' '.join(v.decode('utf-8', 'replace').lower().split()).encode('utf-8'))
+            for k, v in parse_qsl(bytes(parts.query), keep_blank_values=True))
+    return '%s%s?%s' % (parts.netloc.lower(), parts.path.rstrip('/'),
+            urlencode(q))
+
+class PersistentCache(object):  # {{{
+
+    '''
+    A small key/value store on disk, shared by all calibre processes. Values
+    are grouped by kind (isbn->asin, asin->cover url, asin->metadata, ...),
+    expire after ttl seconds and the least recently used entries are evicted
+    once there are more than max_entries of them. SQLite does the locking
+    between processes, a lock serializes the threads of this process.
+    '''
+
+    # Only record an access if the previous one is older than this, so that
+    # lookups do not cause a write every time
+    ACCESS_RESOLUTION = 3600
+    # Check the size bound every so many writes
+    TRIM_INTERVAL = 100
+
+    def __init__(self, path, ttl=30*24*3600, max_entries=500000):
+        self.path, self.ttl, self.max_entries = path, ttl, max_entries
+        self.lock = Lock()
+        self.writes = 0
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                check_same_thread=False)
+        self.conn.text_factory = bytes
+        try:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+            kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,
+            created REAL NOT NULL, accessed REAL NOT NULL,
+            PRIMARY KEY (kind, key))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def get(self, kind, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, created, accessed FROM entries WHERE kind=? AND key=?',
+                (kind, key)).fetchone()
+            if row is None:
+                return None
+            value, created, accessed = row
+            if now - created > self.ttl:
+                self.conn.execute('DELETE FROM entries WHERE kind=? AND key=?',
+                        (kind, key))
+                return None
+            if now - accessed > self.ACCESS_RESOLUTION:
+                self.conn.execute(
+                    'UPDATE entries SET accessed=? WHERE kind=? AND key=?',
+                    (now, kind, key))
+        return zlib.decompress(bytes(value))
+
+    def set(self, kind, key, value):
+        now = time.time()
+        value = sqlite3.Binary(zlib.compress(value))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)',
+                    (kind, key, value, now, now))
+            self.writes += 1
+            if self.writes % self.TRIM_INTERVAL == 0:
+                self.trim(now)
+
+    def delete(self, kind, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE kind=? AND key=?',
+                    (kind, key))
+
+    def trim(self, now):
+        self.conn.execute('DELETE FROM entries WHERE created < ?',
+                (now - self.ttl,))
+        count = self.conn.execute('SELECT count(*) FROM entries').fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('''DELETE FROM entries WHERE rowid IN (
+                SELECT rowid FROM entries ORDER BY accessed LIMIT ?)''',
+                (count - self.max_entries,))
+# }}}
+
+_caches = {}
+_caches_lock = Lock()
+
+def get_cache(path=None, ttl=30*24*3600, max_entries=500000):
+    '''
+    Return the PersistentCache for path, shared by everything in this
+    process.
+    '''
+    path = path or cache_path()
+    with _caches_lock:
+        ans = _caches.get(path, None)
+        if ans is None:
+            ans = _caches[path] = PersistentCache(path, ttl=ttl,
+                    max_entries=max_entries)
+        ans.ttl, ans.max_entries = ttl, max_entries
+        return ans
+
+class ResponseCache(object):  # {{{
+
+    '''
+    Downloaded pages and the fields parsed from them, on disk. Pages are
+    kept with their ETag and Last-Modified headers, so that they can be
+    revalidated with a conditional GET, parsed fields are keyed by a hash of
+    the page they came from. The least recently used entries are evicted
+    once their total size is over max_bytes.
+    '''
+
+    # Only record an access if the previous one is older than this
+    ACCESS_RESOLUTION = 600
+    # Check the size bound every so many writes
+    TRIM_INTERVAL = 50
+
+    def __init__(self, path, max_bytes=100*1024*1024):
+        self.path, self.max_bytes = path, max_bytes
+        self.lock = Lock()
+        self.writes = 0
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                check_same_thread=False)
+        self.conn.text_factory = bytes
+        try:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+            kind TEXT NOT NULL, key TEXT NOT NULL, etag TEXT,
+            last_modified TEXT, value BLOB NOT NULL, size INTEGER NOT NULL,
+            accessed REAL NOT NULL, PRIMARY KEY (kind, key))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def _get(self, kind, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT etag, last_modified, value, accessed FROM entries WHERE kind=? AND key=?',
+                (kind, key)).fetchone()
+            if row is None:
+                return None
+            if now - row[3] > self.ACCESS_RESOLUTION:
+                self.conn.execute(
+                    'UPDATE entries SET accessed=? WHERE kind=? AND key=?',
+                    (now, kind, key))
+        return row[:3]
+
+    def _set(self, kind, key, value, etag=None, last_modified=None):
+        value = zlib.compress(value)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?,?)',
+                    (kind, key, etag, last_modified, sqlite3.Binary(value),
+                        len(value), time.time()))
+            self.writes += 1
+            if self.writes % self.TRIM_INTERVAL == 0:
+                self.trim()
+
+    def get_response(self, url):
+        '''
+        Return (etag, last_modified, body) for url, None if it is not
+        cached.
+        '''
+        row = self._get('response', url.encode('utf-8'))
+        if row is None:
+            return None
+        etag, last_modified, value = row
+        return etag, last_modified, zlib.decompress(bytes(value))
+
+    def set_response(self, url, body, etag=None, last_modified=None):
+        self._set('response', url.encode('utf-8'), body, etag=etag,
+                last_modified=last_modified)
+
+    def get_parsed(self, key):
+        row = self._get('parsed', key)
+        if row is None:
+            return None
+        import cPickle
+        return cPickle.loads(zlib.decompress(bytes(row[2])))
+
+    def set_parsed(self, key, value):
+        import cPickle
+        self._set('parsed', key, cPickle.dumps(value, -1))
+
+    def trim(self):
+        total = self.conn.execute('SELECT sum(size) FROM entries').fetchone()[0] or 0
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% of the limit, so this does not run on every write
+        excess = total - int(self.max_bytes * 0.9)
+        victims = []
+        for kind, key, size in self.conn.execute(
+                'SELECT kind, key, size FROM entries ORDER BY accessed').fetchall():
+            victims.append((kind, key))
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany('DELETE FROM entries WHERE kind=? AND key=?',
+                victims)
+
+    def counters(self):
+        with self.lock:
+            count, size = self.conn.execute(
+                'SELECT count(*), sum(size) FROM entries').fetchone()
+        return {'entries': count, 'bytes': size or 0}
+# }}}
+
+_response_caches = {}
+
+def get_response_cache(path=None, max_bytes=100*1024*1024):
+    '''
+    Return the ResponseCache for path, shared by everything in this process.
+    '''
+    path = path or cache_path('amazon_cn_responses.sqlite')
+    with _caches_lock:
+        ans = _response_caches.get(path, None)
+        if ans is None:
+            ans = _response_caches[path] = ResponseCache(path,
+                    max_bytes=max_bytes)
+        ans.max_bytes = max_bytes
+        return ans
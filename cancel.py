@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Cooperative cancellation of the network work of identify and
+# download_cover. Code making requests runs inside scope(cancel), the
+# connection pool registers every connection it uses with the Cancel of the
+# current scope, and setting the Cancel closes them, so that requests in
+# flight end at once instead of at their timeout.
+
+import socket
+from contextlib import contextmanager
+from itertools import count
+from threading import Thread, Lock, Event, local
+
+class Cancelled(Exception):
+
+    '''
+    The request was not made, or was interrupted, because the work it was
+    for was cancelled.
+    '''
+
+class Cancel(object):  # {{{
+
+    '''
+    An Event that also runs the callbacks registered with it when it is
+    set.
+    '''
+
+    def __init__(self):
+        self.event = Event()
+        self.lock = Lock()
+        self.callbacks = {}
+        self.ids = count()
+        self.following = None
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        return self.event.wait(timeout)
+
+    def set(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks.values(), {}
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def register(self, callback):
+        '''
+        Call callback when this is set, straight away if it already is.
+        Returns a key for unregister().
+        '''
+        with self.lock:
+            if not self.event.is_set():
+                key = next(self.ids)
+                self.callbacks[key] = callback
+                return key
+        callback()
+
+    def unregister(self, key):
+        if key is not None:
+            with self.lock:
+                self.callbacks.pop(key, None)
+
+    def child(self):
+        '''
+        A new Cancel, set when this one is, that can also be set on its own.
+        '''
+        ans = Cancel()
+        self.register(ans.set)
+        return ans
+
+    def follow(self, abort, interval=0.1):
+        '''
+        Set this as soon as abort (an Event set by calibre) is set, until
+        stop_following() is called.
+        '''
+        stop = self.following = Event()
+
+        def run():
+            while not stop.is_set() and not self.is_set():
+                if abort.wait(interval):
+                    self.set()
+
+        t = Thread(target=run, name='AmazonCNAbortWatcher')
+        t.daemon = True
+        t.start()
+
+    def stop_following(self):
+        if self.following is not None:
+            self.following.set()
+# }}}
+
+_local = local()
+
+@contextmanager
+def scope(cancel):
+    '''
+    Make cancel the Cancel of the requests made by this thread in the
+    wrapped block.
+    '''
+    prev = getattr(_local, 'cancel', None)
+    _local.cancel = cancel
+    try:
+        yield
+    finally:
+        _local.cancel = prev
+
+def current():
+    '''
+    The Cancel of the scope this thread is in, None if there is none.
+    '''
+    return getattr(_local, 'cancel', None)
+
+def check(cancel=None):
+    '''
+    Raise Cancelled if cancel, by default the one of the current scope, is
+    set.
+    '''
+    cancel = current() if cancel is None else cancel
+    if cancel is not None and cancel.is_set():
+        raise Cancelled('Cancelled')
+
+def shutdown_connection(conn):
+    '''
+    Close conn, an httplib connection, waking up any thread blocked reading
+    from it.
+    '''
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    conn.close()
+
+@contextmanager
+def following(abort):
+    '''
+    A Cancel set as soon as abort (an Event set by calibre) is, while the
+    wrapped block runs.
+    '''
+    cancel = Cancel()
+    cancel.follow(abort)
+    try:
+        yield cancel
+    finally:
+        cancel.stop_following()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Rendering of book descriptions to the HTML given to sanitize_comments_html
+
+import re
+
+from lxml.etree import XPath
+
+# Every element render_comments() has to change: the ones that are dropped
+# and the ones with attributes, which are all removed
+to_clean = XPath('descendant::noscript | descendant-or-self::*[@*]')
+# Elements that are dropped along with their contents
+JUNK_CLASSES = frozenset(('seeAll', 'emptyClear'))
+JUNK_IDS = frozenset(('collapsePS', 'expandPS'))
+# Comments and the notice about text referring to out of print editions
+junk_markup = re.compile(r'(?s)<!--.*?-->|<em>--This text ref.*?</em>')
+
+def render_comments(desc):
+    '''
+    Serialize the description element desc to HTML without any attributes,
+    links, comments, noscript elements or Amazon's page furniture, for
+    sanitize_comments_html(). Modifies desc.
+    '''
+    from lxml.html import tostring
+    for elem in to_clean(desc):
+        if elem is not desc:
+            if (elem.tag == 'noscript' or elem.get('class') in JUNK_CLASSES or
+                    elem.get('id') in JUNK_IDS):
+                elem.getparent().remove(elem)
+                continue
+            if elem.tag == 'a' and elem.get('href') is not None:
+                elem.tag = 'span'
+        elem.attrib.clear()
+    desc = tostring(desc, method='html', encoding=unicode).strip()
+    # Encoding bug in Amazon data U+fffd (replacement char)
+    # in some examples it is present in place of '
+    return junk_markup.sub('', desc.replace('\ufffd', "'"))
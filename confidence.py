@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+from collections import deque
+from threading import Lock, Event
+
+from calibre.ebooks.metadata import check_isbn
+
+def normalize(text):
+    return re.sub(r'[\W_]+', '', (text or '').lower(), flags=re.UNICODE)
+
+def match_confidence(mi, title=None, authors=None, identifiers={}):
+    '''
+    How sure we are, from 0 to 1, that mi is the book that was looked for.
+    '''
+    asin = identifiers.get('amazon_cn', None)
+    if asin and mi.get_identifiers().get('amazon_cn', None) == asin:
+        return 1.0
+    isbn = check_isbn(identifiers.get('isbn', None))
+    if isbn and mi.isbn and check_isbn(mi.isbn) == isbn:
+        return 1.0
+    ans = 0.0
+    if title and normalize(title) == normalize(mi.title):
+        ans += 0.6
+    if authors:
+        found = set(normalize(a) for a in mi.authors or ())
+        wanted = [normalize(a) for a in authors]
+        if wanted and all(a in found for a in wanted):
+            ans += 0.35
+    return ans
+
+def similarity(title=None, authors=None, candidate_title=None,
+        candidate_authors=None):
+    '''
+    How closely, from 0 to 1, a candidate title and authors resemble the
+    ones looked for. Used to rank search results before anything else is
+    known about them.
+    '''
+    from difflib import SequenceMatcher
+
+    def ratio(a, b):
+        a, b = normalize(a), normalize(b)
+        return SequenceMatcher(None, a, b).ratio() if a and b else 0.0
+
+    ans = 0.0
+    if title:
+        ans += 0.6 * ratio(title, candidate_title)
+    if authors:
+        found = candidate_authors or ()
+        ans += 0.4 * sum(max([ratio(a, c) for c in found] or [0.0])
+                for a in authors) / len(authors)
+    return ans
+
+class ConfidentQueue(object):  # {{{
+
+    '''
+    Stands in for the result queue of identify for the details Workers,
+    scoring every result put on it. confident is set as soon as one of them
+    has a confidence of at least threshold.
+    '''
+
+    def __init__(self, queue, threshold, title=None, authors=None,
+            identifiers={}):
+        self.queue, self.threshold = queue, threshold
+        self.title, self.authors = title, authors
+        self.identifiers = identifiers
+        self.confident = Event()
+        self.rank = None
+        self.lock = Lock()
+
+    def put(self, mi, *args, **kwargs):
+        score = match_confidence(mi, self.title, self.authors,
+                self.identifiers)
+        if score >= self.threshold:
+            with self.lock:
+                if self.rank is None or mi.source_relevance < self.rank:
+                    self.rank = mi.source_relevance
+            self.confident.set()
+        return self.queue.put(mi, *args, **kwargs)
+# }}}
+
+class EditionsLimit(object):  # {{{
+
+    '''
+    The number of search results worth fetching the details pages of,
+    learned from where in the results confident matches were found by recent
+    identify calls: enough for nine out of ten of them, plus one.
+    '''
+
+    def __init__(self, maximum, minimum=2, history=50, warmup=10):
+        self.maximum, self.minimum, self.warmup = maximum, minimum, warmup
+        self.needed = deque(maxlen=history)
+        self.lock = Lock()
+
+    def record(self, rank):
+        '''
+        Record the relevance of the first confident match found by an
+        identify call, None if there was none.
+        '''
+        with self.lock:
+            self.needed.append(self.maximum if rank is None else rank + 1)
+
+    def __call__(self):
+        with self.lock:
+            if len(self.needed) < self.warmup:
+                return self.maximum
+            needed = sorted(self.needed)[int(len(self.needed) * 0.9) - 1]
+        return max(self.minimum, min(self.maximum, needed + 1))
+# }}}
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time, zlib, socket, httplib
+from io import BytesIO
+from threading import Lock
+from urlparse import urlsplit, urljoin
+from urllib import quote, unquote, proxy_bypass
+from urllib2 import HTTPError, URLError, Request
+
+from calibre_plugins.AMAZON_CN.cancel import (current as current_cancel,
+        check as check_cancel, shutdown_connection)
+
+class Response(object):
+
+    '''
+    The parts of a mechanize response the plugin uses, for a body that has
+    already been read completely.
+    '''
+
+    def __init__(self, url, code, msg, headers, data):
+        self.url, self.code, self.msg, self.headers = url, code, msg, headers
+        self.stream = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        self.stream.close()
+
+def split_proxy(proxy):
+    '''
+    Return (host, port, Proxy-Authorization header or None) for proxy, a
+    [user:password@]host[:port] string as returned by calibre.get_proxies().
+    '''
+    parts = urlsplit('//' + proxy)
+    auth = None
+    if parts.username is not None:
+        from base64 import b64encode
+        auth = b'Basic ' + b64encode(b'%s:%s' % (unquote(parts.username),
+            unquote(parts.password or '')))
+    return parts.hostname, parts.port or 80, auth
+
+class ConnectionPool(object):  # {{{
+
+    '''
+    Persistent HTTP connections, shared by all the threads of the process.
+    Idle connections are kept per host (and proxy), at most max_per_host of
+    them and max_idle in total, and closed once they have been idle for
+    idle_timeout seconds. Requests go through the proxies given to
+    request(), https ones through a CONNECT tunnel.
+    '''
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, max_per_host=6, max_idle=20, idle_timeout=60):
+        self.max_per_host, self.max_idle = max_per_host, max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.idle = {}
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def evict(self, now):
+        # Must be called with the lock held
+        for key, conns in self.idle.items():
+            keep = [(c, t) for c, t in conns if now - t < self.idle_timeout]
+            for c, t in conns:
+                if now - t >= self.idle_timeout:
+                    c.close()
+                    self.stats['evictions'] += 1
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+
+    def get(self, key, timeout):
+        with self.lock:
+            self.evict(time.time())
+            conns = self.idle.get(key, None)
+            conn = conns.pop()[0] if conns else None
+            self.stats['hits' if conn is not None else 'misses'] += 1
+        if conn is None:
+            scheme, host, port, proxy = key
+            cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            if proxy is None:
+                conn = cls(host, port, timeout=timeout)
+            else:
+                phost, pport, auth = split_proxy(proxy)
+                conn = cls(phost, pport, timeout=timeout)
+                if scheme == 'https':
+                    conn.set_tunnel(host, port, headers={
+                        b'Proxy-Authorization': auth} if auth else None)
+            return conn, False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def put(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            total = sum(len(x) for x in self.idle.itervalues())
+            if len(conns) < self.max_per_host and total < self.max_idle:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def counters(self):
+        with self.lock:
+            ans = dict(self.stats)
+            ans['idle'] = sum(len(x) for x in self.idle.itervalues())
+        return ans
+
+    def request(self, url, headers={}, timeout=None, method='GET',
+            proxies=None, cookies=None):
+        '''
+        Make the request, following redirects. proxies maps url schemes to
+        proxies, as returned by calibre.get_proxies(). cookies is a cookielib
+        CookieJar, whose cookies are sent and which keeps the cookies set by
+        the server.
+        '''
+        for i in xrange(self.MAX_REDIRECTS + 1):
+            req = Request(url, headers=headers)
+            if cookies is not None:
+                cookies.add_cookie_header(req)
+            proxy = (proxies or {}).get(req.get_type(), None)
+            if proxy is not None and proxy_bypass(req.get_host()):
+                proxy = None
+            code, msg, hdrs, data = self._request(url, dict(req.header_items()),
+                    timeout, method, proxy)
+            if cookies is not None:
+                cookies.extract_cookies(Response(url, code, msg, hdrs, b''), req)
+            if code in (301, 302, 303, 307) and hdrs.get('Location'):
+                url = urljoin(url, hdrs.get('Location'))
+                continue
+            break
+        if hdrs.get('Content-Encoding', '').lower() == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        if not (200 <= code < 300):
+            raise HTTPError(url, code, msg, hdrs, BytesIO(data))
+        return Response(url, code, msg, hdrs, data)
+
+    def _request(self, url, headers, timeout, method, proxy=None):
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port, proxy)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict((bytes(k), bytes(v)) for k, v in headers.iteritems())
+        if proxy is not None and scheme == 'http':
+            # Plain http proxies are sent the whole url
+            path = '%s://%s%s' % (scheme, parts.netloc, path)
+            auth = split_proxy(proxy)[2]
+            if auth:
+                headers[b'Proxy-Authorization'] = auth
+        # httplib wants bytes, non ascii characters in urls must be quoted
+        path = quote(path.encode('utf-8') if isinstance(path, unicode) else path,
+                safe=b"/?&=%:;,+@!$'()*~#")
+        cancel = current_cancel()
+        while True:
+            check_cancel(cancel)
+            conn, reused = self.get(key, timeout)
+            # Cancelling the request closes the connection, ending the request
+            cancel_key = None if cancel is None else cancel.register(
+                    lambda: shutdown_connection(conn))
+            try:
+                # Closing a connection that is not connected yet does not
+                # stop request() from connecting
+                check_cancel(cancel)
+                conn.request(bytes(method), path, headers=headers)
+                res = conn.getresponse()
+                data = res.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                check_cancel(cancel)
+                if reused:
+                    # The server closed the idle connection, try a new one
+                    continue
+                raise URLError(e)
+            finally:
+                if cancel is not None:
+                    cancel.unregister(cancel_key)
+            if cancel is not None and cancel.is_set():
+                # What was read may be incomplete
+                conn.close()
+                check_cancel(cancel)
+            if res.will_close:
+                conn.close()
+            else:
+                self.put(key, conn)
+            return res.status, res.reason, res.msg, data
+# }}}
+
+class PooledBrowser(object):
+
+    '''
+    Stands in for the mechanize browser of the plugin, sending every request
+    over the connections of a ConnectionPool, through the proxies calibre is
+    set up to use and with the cookies in cookies. It is safe to share
+    between threads, so clone_browser() returns the same object.
+    '''
+
+    def __init__(self, pool, addheaders=(), proxies=None, cookies=None):
+        from cookielib import CookieJar
+        self.pool = pool
+        if proxies is None:
+            from calibre import get_proxies
+            proxies = get_proxies(debug=False)
+        self.proxies = proxies
+        self.cookies = CookieJar() if cookies is None else cookies
+        self.addheaders = list(addheaders)
+        if not any(k.lower() == 'accept-encoding' for k, v in self.addheaders):
+            self.addheaders.append(('Accept-Encoding', 'gzip'))
+
+    def clone_browser(self):
+        return self
+
+    def open_novisit(self, url_or_request, timeout=None):
+        headers = dict(self.addheaders)
+        if hasattr(url_or_request, 'get_full_url'):
+            url = url_or_request.get_full_url()
+            headers.update(url_or_request.header_items())
+        else:
+            url = url_or_request
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        return self.pool.request(url, headers=headers, timeout=timeout,
+                proxies=self.proxies, cookies=self.cookies)
+    open = open_novisit
+
+class CachingBrowser(object):
+
+    '''
+    Wraps a browser, keeping the pages it downloads in a ResponseCache and
+    revalidating them with a conditional GET the next time they are asked
+    for. A 304 answer costs a request but no download. Only plain GETs of a
+    url are cached, requests with their own headers (ranged cover requests)
+    go straight to the wrapped browser. Failures of the cache are passed to
+    on_error, called with a message while the exception is being handled.
+    '''
+
+    def __init__(self, browser, cache, on_error=None):
+        self.browser, self.cache = browser, cache
+        self.on_error = on_error
+
+    def cache_failed(self, msg):
+        if self.on_error is None:
+            import traceback
+            traceback.print_exc()
+        else:
+            self.on_error(msg)
+
+    @property
+    def addheaders(self):
+        return self.browser.addheaders
+
+    def clone_browser(self):
+        return CachingBrowser(self.browser.clone_browser(), self.cache,
+                on_error=self.on_error)
+
+    def open_novisit(self, url_or_request, timeout=None):
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        if hasattr(url_or_request, 'get_full_url'):
+            return self.browser.open_novisit(url_or_request, timeout=timeout)
+        url = url_or_request
+        try:
+            entry = self.cache.get_response(url)
+        except Exception:
+            self.cache_failed('Failed to read from the response cache')
+            entry = None
+        request = url
+        if entry is not None:
+            from mechanize import Request
+            etag, last_modified, body = entry
+            headers = {}
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+            request = Request(url, headers=headers)
+        try:
+            res = self.browser.open_novisit(request, timeout=timeout)
+        except HTTPError as e:
+            if entry is None or e.code != 304:
+                raise
+            metrics.count('http_cache', 'revalidated')
+            return Response(url, 200, 'OK', e.info(), body)
+        data = res.read()
+        info = res.info()
+        etag, last_modified = info.get('ETag'), info.get('Last-Modified')
+        no_store = 'no-store' in (info.get('Cache-Control') or '').lower()
+        if (etag or last_modified) and not no_store:
+            metrics.count('http_cache', 'miss' if entry is None else 'changed')
+            try:
+                self.cache.set_response(url, data, etag=etag,
+                        last_modified=last_modified)
+            except Exception:
+                self.cache_failed('Failed to write to the response cache')
+        else:
+            metrics.count('http_cache', 'uncacheable')
+        code = getattr(res, 'code', 200)
+        return Response(res.geturl() if callable(getattr(res, 'geturl', None))
+                else url, code, getattr(res, 'msg', 'OK'), info, data)
+    open = open_novisit
+
+_pool = None
+_pool_lock = Lock()
+
+def get_pool():
+    '''
+    Return the ConnectionPool shared by everything in this process.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re, struct
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+
+from calibre_plugins.AMAZON_CN.metrics import metrics
+
+# Number of bytes requested when checking that a cover image exists. The
+# bytes are kept and reused by download_cover, so nothing is fetched twice.
+PROBE_BYTES = 16 * 1024
+
+# Number of bytes requested when reading the dimensions of an image
+HEADER_BYTES = 8 * 1024
+
+# Most bytes downloaded to find the dimensions of an image, EXIF data and
+# color profiles before the frame header of a JPEG can be big
+MAX_HEADER_BYTES = 256 * 1024
+
+content_range_pat = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+def scrm_cover_url(asin):
+    return 'http://z2-ec2.images-amazon.com/images/P/'+asin+'.01.MAIN._SCRM_.jpg'
+
+def cover_variants(asin):
+    '''
+    The urls of the sizes Amazon may have of the cover of asin, biggest
+    usually first. Sizes Amazon does not have are served as a 1x1 pixel
+    image.
+    '''
+    base = 'http://images.amazon.com/images/P/' + asin
+    return [scrm_cover_url(asin), base + '.01._SCRMZZZZZZ_.jpg',
+            base + '.01.LZZZZZZZ.jpg', base + '.01._SCLZZZZZZZ_.jpg',
+            base + '.01.MZZZZZZZ.jpg']
+
+def image_size(data):
+    '''
+    Return (width, height) of the JPEG, PNG or GIF image whose first bytes
+    are data, None if they are not enough to tell.
+    '''
+    return image_header(data)[0]
+
+def image_header(data):
+    '''
+    Return (size, needed) for the image whose first bytes are data. size is
+    as returned by image_size(). needed is the number of bytes of the image
+    to download to tell its size if data ends before the frame header of a
+    JPEG, None otherwise.
+    '''
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack(b'>II', data[16:24]), None
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return struct.unpack(b'<HH', data[6:10]), None
+    if data[:2] != b'\xff\xd8':
+        return None, None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != b'\xff':
+            return None, None
+        marker = ord(data[i+1])
+        if marker == 0xff:
+            # Padding
+            i += 1
+            continue
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            # Start of frame
+            h, w = struct.unpack(b'>HH', data[i+5:i+9])
+            return (w, h), None
+        i += 2 + struct.unpack(b'>H', data[i+2:i+4])[0]
+    # The next segment starts at i
+    return None, i + 9
+
+def is_cover(data):
+    '''
+    True if data, the first bytes of an image, are not the 1x1 pixel
+    placeholder Amazon serves for images it does not have. The start of a
+    JPEG too short to read its size from counts as a cover.
+    '''
+    size, needed = image_header(data)
+    if size is None:
+        return needed is not None
+    return min(size) > 1
+
+def full_size_cover_url(src):
+    '''
+    The url of the full size version of the Amazon image src, None if src
+    has no size suffix to remove.
+    '''
+    parts = src.split('/')
+    if len(parts) > 3:
+        bn = parts[-1]
+        sparts = bn.split('_')
+        if len(sparts) > 2:
+            bn = re.sub(r'\.\.jpg$', '.jpg', (sparts[0] + sparts[-1]))
+            return ('/'.join(parts[:-1]))+'/'+bn
+
+def open_range(browser, url, start, end=None, timeout=20):
+    '''
+    Open url asking only for the bytes [start, end]. Returns the response,
+    servers that ignore the Range header answer with the complete body.
+    '''
+    from mechanize import Request
+    rng = 'bytes=%d-%s' % (start, '' if end is None else end)
+    return browser.open_novisit(Request(url, headers={'Range': rng}),
+            timeout=timeout)
+
+@contextmanager
+def slot(scheduler):
+    if scheduler is None:
+        yield
+    else:
+        with scheduler.slot():
+            yield
+
+def fetch_rest(browser, url, data, complete, timeout=20, scheduler=None):
+    '''
+    Return the complete image at url, of which the first bytes, data, have
+    already been downloaded (all of it if complete).
+    '''
+    if complete:
+        return data
+    with slot(scheduler), metrics.timer('fetch.cover'):
+        res = open_range(browser, url, len(data), timeout=timeout)
+        rest = res.read()
+    metrics.count('bytes', 'cover', len(rest))
+    if getattr(res, 'code', None) == 206:
+        data += rest
+    else:
+        # Range was ignored, we got the complete image
+        data = rest
+    res.close()
+    return data
+
+def is_complete(res, data, start=0):
+    '''
+    Return True if data (read from res, starting at offset start) is the
+    complete resource.
+    '''
+    code = getattr(res, 'code', None)
+    if code is None and callable(getattr(res, 'getcode', None)):
+        code = res.getcode()
+    if code != 206:
+        return True
+    m = content_range_pat.match(res.info().get('Content-Range', '') or '')
+    if m is None or m.group(3) == '*':
+        return False
+    return start + len(data) >= int(m.group(3))
+
+class CoverProbe(Thread):  # {{{
+
+    '''
+    Check, in a separate thread, which of a list of candidate cover urls
+    exists, using a ranged GET through the plugin's browser. A placeholder
+    image does not count, see is_cover(). on_failed(probe) is called if none
+    of them exists, or the probe was cancelled.
+    '''
+
+    def __init__(self, asin, urls, browser, log, timeout=20, on_found=None,
+            scheduler=None, cancel=None, on_failed=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.asin, self.urls = asin, urls
+        self.scheduler, self.cancel = scheduler, cancel
+        self.browser = browser.clone_browser()
+        self.log, self.timeout = log, timeout
+        self.on_found, self.on_failed = on_found, on_failed
+        self.url = self.data = None
+        self.complete = False
+        self.finished = Event()
+
+    def run(self):
+        from calibre_plugins.AMAZON_CN.cancel import scope
+        try:
+            for url in self.urls:
+                if self.cancel is not None and self.cancel.is_set():
+                    break
+                try:
+                    with slot(self.scheduler), scope(self.cancel), \
+                            metrics.timer('cover_probe'):
+                        res = open_range(self.browser, url, 0, PROBE_BYTES - 1,
+                                timeout=self.timeout)
+                        data = res.read()
+                    complete = is_complete(res, data)
+                    res.close()
+                except Exception:
+                    continue
+                metrics.count('bytes', 'cover', len(data))
+                if is_cover(data):
+                    self.url, self.data, self.complete = url, data, complete
+                    if self.on_found is not None:
+                        self.on_found(self.asin, url)
+                    break
+        finally:
+            if self.url is None and self.on_failed is not None:
+                self.on_failed(self)
+            self.finished.set()
+# }}}
+
+class CoverProbes(object):  # {{{
+
+    '''
+    The cover probes started for a plugin instance, keyed by ASIN. Only the
+    most recent probes are kept, to bound the memory used by their data.
+    on_found(asin, url) is called from the probe thread when a cover is found.
+    '''
+
+    MAX_PROBES = 50
+
+    def __init__(self, on_found=None):
+        self.on_found = on_found
+        self.lock = Lock()
+        self.probes = OrderedDict()
+
+    def start(self, asin, urls, browser, log, timeout=20, scheduler=None,
+            cancel=None):
+        with self.lock:
+            if asin in self.probes:
+                return self.probes[asin]
+            p = self.probes[asin] = CoverProbe(asin, urls, browser, log,
+                    timeout=timeout, on_found=self.on_found,
+                    scheduler=scheduler, cancel=cancel,
+                    on_failed=self.discard)
+            while len(self.probes) > self.MAX_PROBES:
+                self.probes.popitem(last=False)
+        p.start()
+        return p
+
+    def discard(self, probe):
+        '''
+        Forget probe, so that the next start() for its ASIN probes again.
+        '''
+        with self.lock:
+            if self.probes.get(probe.asin, None) is probe:
+                del self.probes[probe.asin]
+
+    def get(self, asin, timeout=None):
+        '''
+        Wait up to timeout seconds for the probe for asin. Returns the probe
+        if it found a cover, None otherwise.
+        '''
+        with self.lock:
+            p = self.probes.get(asin, None)
+        if p is None:
+            return None
+        p.finished.wait(timeout)
+        if p.finished.is_set() and p.url is not None:
+            return p
+
+    def fetch(self, asin, browser, log, timeout=20, scheduler=None):
+        '''
+        Return (url, data) for the cover found by the probe for asin,
+        downloading only the bytes the probe did not already fetch.
+        '''
+        p = self.get(asin, timeout=timeout)
+        if p is None:
+            return None, None
+        data = fetch_rest(browser, p.url, p.data, p.complete, timeout=timeout,
+                scheduler=scheduler)
+        with self.lock:
+            self.probes.pop(asin, None)
+        return p.url, data
+# }}}
+
+class SizeProbe(Thread):
+
+    '''
+    Download, in a separate thread, just enough of an image to read its
+    dimensions. More than HEADER_BYTES are downloaded, up to
+    MAX_HEADER_BYTES, only if the frame header of a JPEG comes after them.
+    '''
+
+    def __init__(self, url, browser, timeout=20, scheduler=None, cancel=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.url, self.browser = url, browser.clone_browser()
+        self.timeout, self.scheduler = timeout, scheduler
+        self.cancel = cancel
+        self.size = self.data = None
+        self.complete = False
+
+    def run(self):
+        from calibre_plugins.AMAZON_CN.cancel import scope, check
+        data, complete, needed = b'', False, HEADER_BYTES
+        try:
+            with slot(self.scheduler), scope(self.cancel), \
+                    metrics.timer('cover_size_probe'):
+                while needed is not None and not complete:
+                    check()
+                    start = len(data)
+                    res = open_range(self.browser, self.url, start,
+                            max(needed, start + HEADER_BYTES) - 1,
+                            timeout=self.timeout)
+                    more = res.read()
+                    metrics.count('bytes', 'cover', len(more))
+                    if start == 0 or getattr(res, 'code', None) == 206:
+                        complete = is_complete(res, more, start=start)
+                        data += more
+                    else:
+                        # Range was ignored, we got the complete image
+                        data, complete = more, True
+                    res.close()
+                    size, needed = image_header(data)
+                    if needed is not None and needed > MAX_HEADER_BYTES:
+                        break
+        except Exception:
+            return
+        self.data, self.complete, self.size = data, complete, size
+
+def best_cover(urls, browser, log, timeout=20, scheduler=None, cancel=None):
+    '''
+    Probe the dimensions of the images at urls in parallel and return
+    (url, width, height, data, complete) for the biggest one, where data are
+    the bytes downloaded by the probe. None if none of them is a real image.
+    '''
+    probes = [SizeProbe(url, browser, timeout=timeout, scheduler=scheduler,
+        cancel=cancel) for url in urls]
+    for p in probes:
+        p.start()
+    best = None
+    for p in probes:
+        p.join(timeout)
+        if p.size is None:
+            if p.data:
+                log('Could not read the size of the cover: %s' % p.url)
+            continue
+        w, h = p.size
+        log('Cover size %dx%d: %s' % (w, h, p.url))
+        # Missing sizes are served as tiny placeholders
+        if min(w, h) > 1 and (best is None or w * h > best[1] * best[2]):
+            best = (p.url, w, h, p.data, p.complete)
+    return best
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Fetch engines run the details Workers started by identify. submit() takes
+# a Worker and returns an object with the join(timeout) and is_alive()
+# methods of a thread, which is all identify needs.
+
+from threading import Thread, Lock, Event
+from Queue import Queue
+
+from calibre_plugins.AMAZON_CN.metrics import profiling
+
+class ThreadEngine(object):
+
+    '''
+    Every Worker runs in its own thread with its own clone of the browser.
+    '''
+
+    name = 'threads'
+    clone_browser = True
+
+    def submit(self, worker):
+        worker.start()
+        return worker
+
+class Job(object):
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.done = Event()
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+    def is_alive(self):
+        return not self.done.is_set()
+
+class PoolEngine(object):  # {{{
+
+    '''
+    A fixed set of fetcher threads download the pages of all Workers in the
+    process. Each keeps one clone of the browser of the lookup it is working
+    for, the Workers of one lookup share its browser, so that the browser,
+    cookies and caching settings are those of the plugin that made the
+    lookup. The downloaded pages are handed to a separate set of parser
+    threads, so that parsing never holds up a download.
+    '''
+
+    name = 'pool'
+    clone_browser = False
+
+    def __init__(self, fetchers=5, parsers=2):
+        self.fetch_queue, self.parse_queue = Queue(), Queue()
+        self.threads = []
+        for i in xrange(fetchers):
+            self._start(self.fetch_loop, 'AmazonCNFetcher%d' % i)
+        for i in xrange(parsers):
+            self._start(self.parse_loop, 'AmazonCNParser%d' % i)
+
+    def _start(self, target, name):
+        t = Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def submit(self, worker):
+        job = Job(worker)
+        self.fetch_queue.put(job)
+        return job
+
+    def fetch_loop(self):
+        source = browser = None
+        while True:
+            job = self.fetch_queue.get()
+            w = job.worker
+            try:
+                if w.browser is not source:
+                    source = None
+                    browser = w.browser.clone_browser()
+                    source = w.browser
+                # A list, so that the parser can take the bytes out of it,
+                # see Worker.process()
+                with profiling(w.profile):
+                    page = [w.fetch(browser)]
+            except:
+                w.log.exception('Failed to download: %r'%w.url)
+                page = [None]
+            if page[0] is None:
+                job.done.set()
+            else:
+                self.parse_queue.put((job, page))
+
+    def parse_loop(self):
+        while True:
+            job, page = self.parse_queue.get()
+            try:
+                with profiling(job.worker.profile):
+                    job.worker.process(page)
+            except:
+                job.worker.log.exception('get_details failed for url: %r'%job.worker.url)
+            finally:
+                job.done.set()
+# }}}
+
+_engines = {}
+_engines_lock = Lock()
+
+def get_engine(name='threads', fetchers=5, parsers=2):
+    '''
+    Return the fetch engine called name, shared by everything in this process.
+    '''
+    if name != PoolEngine.name:
+        return ThreadEngine()
+    key = (name, fetchers, parsers)
+    with _engines_lock:
+        ans = _engines.get(key, None)
+        if ans is None:
+            ans = _engines[key] = PoolEngine(fetchers=fetchers, parsers=parsers)
+        return ans
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import sys
+from threading import Lock, Event
+
+class Flight(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = self.exc_info = None
+
+class SingleFlight(object):  # {{{
+
+    '''
+    Coalesces concurrent calls for the same key: while a call of do() for a
+    key is running, other calls of do() with that key wait for it and get
+    its result (or its exception) instead of doing the work again. If that
+    call was cancelled (see cancel.py), one of them makes it again. Calls
+    made after it finished do the work again, nothing is cached.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.flights = {}
+
+    def do(self, key, func, share=None):
+        '''
+        Return func(), or the result of the call already running for key.
+        share, if given, is applied to a result before it is handed to a
+        waiting caller, for results that must not be modified by more than
+        one of them.
+        '''
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        with self.lock:
+            flight = self.flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            from calibre_plugins.AMAZON_CN.cancel import Cancelled, check
+            metrics.count('coalesced', self.name)
+            flight.done.wait()
+            if flight.exc_info is not None:
+                if issubclass(flight.exc_info[0], Cancelled):
+                    # Only the caller that made the request was cancelled
+                    check()
+                    return self.do(key, func, share=share)
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return flight.result if share is None else share(flight.result)
+        try:
+            flight.result = func()
+        except:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+# }}}
+
+_flights = {}
+_flights_lock = Lock()
+
+def get_flight(name):
+    '''
+    Return the SingleFlight for requests of the kind name (search, details,
+    cover), shared by everything in this process.
+    '''
+    with _flights_lock:
+        ans = _flights.get(name, None)
+        if ans is None:
+            ans = _flights[name] = SingleFlight(name)
+        return ans
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, json, time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+# Upper bounds, in seconds, of the buckets of the timing histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+        30, float('inf'))
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count, self.sum = 0, 0.0
+
+    def add(self, val):
+        self.count += 1
+        self.sum += val
+        for i, le in enumerate(BUCKETS):
+            if val <= le:
+                self.counts[i] += 1
+                break
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': [('+Inf' if le == float('inf') else le, c)
+                    for le, c in zip(BUCKETS, self.counts)]}
+
+class Metrics(object):  # {{{
+
+    '''
+    Timing histograms per phase (fetch, decode, parse, each field extractor,
+    ...) and counters (bytes transferred, errors, ...) for everything the
+    plugin does in this process.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms, self.counters = {}, {}
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            h = self.histograms.get(phase, None)
+            if h is None:
+                h = self.histograms[phase] = Histogram()
+            h.add(seconds)
+
+    def count(self, name, label, amount=1):
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, phase):
+        '''
+        Time the wrapped block as phase, counting exceptions it raises as
+        errors of that phase.
+        '''
+        st = time.time()
+        try:
+            yield
+        except:
+            self.count('errors', phase)
+            raise
+        finally:
+            self.observe(phase, time.time() - st)
+
+    def timed(self, phase):
+        '''
+        Decorator timing every call of a function as phase.
+        '''
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def export(self):
+        '''
+        The raw metrics, to be merged into those of another process.
+        '''
+        with self.lock:
+            return dict(self.histograms), dict(self.counters)
+
+    def merge(self, state):
+        histograms, counters = state
+        with self.lock:
+            for phase, h in histograms.iteritems():
+                self.histograms.setdefault(phase, Histogram()).merge(h)
+            for key, val in counters.iteritems():
+                self.counters[key] = self.counters.get(key, 0) + val
+
+    def snapshot(self, gauges=None):
+        with self.lock:
+            ans = {
+                'timings': dict((k, v.as_dict()) for k, v in
+                    self.histograms.iteritems()),
+                'counters': dict(('%s.%s' % k, v) for k, v in
+                    self.counters.iteritems()),
+            }
+        ans['gauges'] = dict(gauges or {})
+        return ans
+
+    def to_json(self, gauges=None):
+        return json.dumps(self.snapshot(gauges), indent=2, sort_keys=True)
+
+    def to_prometheus(self, gauges=None):
+        snap = self.snapshot(gauges)
+        lines = ['# TYPE amazon_cn_duration_seconds histogram']
+        for phase, h in sorted(snap['timings'].iteritems()):
+            cumulative = 0
+            for le, c in h['buckets']:
+                cumulative += c
+                lines.append('amazon_cn_duration_seconds_bucket{phase="%s",le="%s"} %d' % (
+                    phase, le, cumulative))
+            lines.append('amazon_cn_duration_seconds_sum{phase="%s"} %f' % (phase, h['sum']))
+            lines.append('amazon_cn_duration_seconds_count{phase="%s"} %d' % (phase, h['count']))
+        with self.lock:
+            counters = dict(self.counters)
+        names = sorted(set(k[0] for k in counters))
+        for name in names:
+            lines.append('# TYPE amazon_cn_%s_total counter' % name)
+            for (n, label), v in sorted(counters.iteritems()):
+                if n == name:
+                    lines.append('amazon_cn_%s_total{name="%s"} %d' % (name, label, v))
+        for name, v in sorted(snap['gauges'].iteritems()):
+            lines.append('# TYPE amazon_cn_%s gauge' % name)
+            lines.append('amazon_cn_%s %s' % (name, v))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, gauges=None):
+        '''
+        Write the metrics to path, as JSON if it ends with .json and in the
+        Prometheus text format otherwise.
+        '''
+        from tempfile import NamedTemporaryFile
+        from calibre.utils.filenames import atomic_rename
+        if path.lower().endswith('.json'):
+            raw = self.to_json(gauges)
+        else:
+            raw = self.to_prometheus(gauges)
+        # Every call writes its own file, calls from concurrent identify()s
+        # must not truncate or rename the file of another
+        with NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)),
+                prefix=os.path.basename(path) + '.', suffix='.tmp',
+                delete=False) as f:
+            f.write(raw.encode('utf-8'))
+        try:
+            atomic_rename(f.name, path)
+        except:
+            os.remove(f.name)
+            raise
+# }}}
+
+metrics = Metrics()
+
+class Profile(object):
+
+    '''
+    The cProfile profiles of all the threads doing the work of one profiled()
+    block, one per thread as cProfile only sees the thread it is enabled in.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.profiles = []
+
+    @contextmanager
+    def thread(self):
+        '''
+        Profile the wrapped block, run by a thread other than the one of the
+        profiled() block.
+        '''
+        import cProfile
+        pr = cProfile.Profile()
+        pr.enable()
+        try:
+            yield
+        finally:
+            pr.disable()
+            with self.lock:
+                self.profiles.append(pr)
+
+_local = local()
+
+def current_profile():
+    '''
+    The Profile of the profiled() block this thread is in, None if there is
+    none. Things started by the block, that run in other threads, take it
+    with them.
+    '''
+    return getattr(_local, 'profile', None)
+
+@contextmanager
+def profiling(profile):
+    '''
+    Profile the wrapped block into profile, from current_profile(), if it is
+    not None.
+    '''
+    if profile is None:
+        yield
+    else:
+        with profile.thread():
+            yield
+
+@contextmanager
+def profiled(log, path=None):
+    '''
+    Profile the wrapped block with cProfile, together with the work of the
+    threads that take current_profile() with them. The statistics are
+    written to path if given, otherwise the most expensive calls are logged.
+    Threads still running when the block ends are left out.
+    '''
+    import cProfile, pstats
+    from io import BytesIO
+    profile = Profile()
+    prev = current_profile()
+    _local.profile = profile
+    pr = cProfile.Profile()
+    pr.enable()
+    try:
+        yield
+    finally:
+        pr.disable()
+        _local.profile = prev
+        buf = BytesIO()
+        stats = pstats.Stats(pr, stream=buf)
+        with profile.lock:
+            profiles, profile.profiles = profile.profiles, []
+        for other in profiles:
+            stats.add(other)
+        if path:
+            stats.dump_stats(path)
+            log('Profile written to:', path)
+        else:
+            stats.sort_stats('cumulative').print_stats(30)
+            log(buf.getvalue().decode('utf-8', 'replace'))
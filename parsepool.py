@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Parsing of details pages in a pool of worker processes, so that bulk
+# downloads are not limited to one core by the GIL. The workers are forked
+# from the calibre process, so this is not available on Windows.
+
+import os, time
+from threading import Lock, Thread
+
+# The fields of the Metadata built by Worker.parse_details()
+FIELDS = ('identifiers', 'rating', 'comments', 'series', 'series_index',
+        'tags', 'isbn', 'publisher', 'pubdate', 'languages', 'has_cover',
+        'source_relevance')
+# The attributes of the Worker set while parsing
+WORKER_ATTRIBUTES = ('generation', 'not_found', 'cover_url', 'amazon_id',
+        'isbn')
+
+def metadata_to_fields(mi):
+    ans = {'title': mi.title, 'authors': list(mi.authors)}
+    for field in FIELDS:
+        val = mi.get_identifiers() if field == 'identifiers' else getattr(mi, field)
+        if val is not None:
+            ans[field] = val
+    return ans
+
+def fields_to_metadata(fields):
+    from calibre.ebooks.metadata.book.base import Metadata
+    fields = dict(fields)
+    mi = Metadata(fields.pop('title'), fields.pop('authors'))
+    mi.set_identifiers(fields.pop('identifiers', {}))
+    for field, val in fields.iteritems():
+        setattr(mi, field, val)
+    return mi
+
+def init_child():
+    # Locks held by other threads of the parent when it forked stay locked
+    # forever in the child
+    from calibre_plugins.AMAZON_CN import metrics, parsing
+    metrics.metrics.lock = Lock()
+    parsing._stats_lock = Lock()
+
+def parse_details_page(url, relevance, raw, partial, backend):
+    '''
+    Run in the worker processes. Returns the metadata fields found in the
+    details page raw (None if it is not usable), the Worker attributes set
+    while parsing it, the log and the metrics.
+    '''
+    from io import BytesIO
+    from calibre.ebooks.metadata.sources.base import create_log
+    from calibre_plugins.AMAZON_CN.metrics import metrics
+    from calibre_plugins.AMAZON_CN.worker import Worker
+    buf = BytesIO()
+    log = create_log(buf)
+    metrics.reset()
+    w = Worker(url, None, None, log, relevance, None, clone_browser=False)
+    try:
+        mi = w.parse_page([raw], partial=partial, backend=backend)
+    except Exception:
+        log.exception('Failed to parse details page: %r' % url)
+        mi = None
+    attrs = dict((x, getattr(w, x)) for x in WORKER_ATTRIBUTES)
+    return (None if mi is None else metadata_to_fields(mi), attrs,
+            buf.getvalue(), metrics.export())
+
+class ParsePool(object):  # {{{
+
+    '''
+    A pool of processes parsing the pages of details Workers. parse() blocks
+    the calling thread, not the GIL, while the page is parsed, so every
+    thread calling it can keep one process busy.
+
+    The processes are forked from a process running other threads, a lock
+    held by one of them when the pool is created stays locked forever in the
+    children. Create the pool before starting threads, and do not rely on
+    the children answering: parse() gives up after a timeout, after which
+    the pool is not used any more.
+    '''
+
+    def __init__(self, processes):
+        import multiprocessing
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, initializer=init_child)
+        self.broken = False
+
+    def parse(self, worker, raw, partial=True, backend='lxml', timeout=30):
+        '''
+        Parse the details page raw downloaded by worker, returning the
+        Metadata rebuilt from the fields found in it or None, as
+        Worker.parse_page() does. Raises Cancelled if the worker is cancelled
+        while waiting and multiprocessing.TimeoutError if no process has
+        parsed the page within timeout seconds.
+        '''
+        from multiprocessing import TimeoutError
+        from calibre_plugins.AMAZON_CN.cancel import Cancelled
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        if self.broken:
+            raise TimeoutError('The parser processes stopped answering')
+        res = self.pool.apply_async(parse_details_page,
+                (worker.url, worker.relevance, raw, partial, backend))
+        end = time.time() + timeout
+        while True:
+            if worker.cancelled():
+                raise Cancelled('Cancelled')
+            try:
+                fields, attrs, log, state = res.get(
+                        max(0, min(end - time.time(), 0.1)))
+                break
+            except TimeoutError:
+                if time.time() >= end:
+                    metrics.count('errors', 'parse_pool_timeout')
+                    self.broken = True
+                    # Terminating waits for the stuck processes
+                    t = Thread(target=self.close, name='AmazonCNParsePoolClose')
+                    t.daemon = True
+                    t.start()
+                    raise
+        metrics.merge(state)
+        if log:
+            worker.log(log.decode('utf-8', 'replace').rstrip())
+        for name, val in attrs.iteritems():
+            setattr(worker, name, val)
+        return None if fields is None else fields_to_metadata(fields)
+
+    def close(self):
+        self.pool.terminate()
+# }}}
+
+_pools = {}
+_pools_lock = Lock()
+
+def get_parse_pool(processes, restart=False):
+    '''
+    Return the ParsePool with the given number of processes, shared by
+    everything in this process. None where processes cannot be forked. A
+    pool whose processes stopped answering is replaced only if restart is
+    True, see ParsePool.
+    '''
+    if not hasattr(os, 'fork'):
+        return None
+    with _pools_lock:
+        ans = _pools.get(processes, None)
+        if ans is None or (ans.broken and restart):
+            ans = _pools[processes] = ParsePool(processes)
+        return ans
+
+def shutdown_parse_pools():
+    with _pools_lock:
+        for pool in _pools.itervalues():
+            pool.close()
+        _pools.clear()
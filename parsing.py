@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+from threading import Lock
+
+from lxml.etree import XPath
+
+from calibre_plugins.AMAZON_CN import xpaths
+
+# Nodes that must be present for a parse of a page to be trusted, if any of
+# them is missing the page is parsed again with html5lib
+RESULTS_PAGE_REQUIRED = (
+    XPath('//li[starts-with(@id, "result_")] | //div[starts-with(@id, "result_")]'
+    ' | //div[@id="Results"]'),
+)
+DETAILS_PAGE_REQUIRED = (
+    xpaths.canonical_link,
+    XPath('//h1[@id="title"] | //h1[contains(@class, "parseasinTitle")]'),
+)
+
+# Markers identifying each generation of the page markup, checked in order
+RESULTS_GENERATIONS = (
+    ('s_access', ('s-access-detail-page',)),
+    ('mobile', ('search:Td:',)),
+    ('result_div', ('id="result_',)),
+)
+DETAILS_GENERATIONS = (
+    ('new', ('id="title"', 'id="byline"')),
+    ('new', ('nonHeroSection',)),
+    ('old', ('parseasinTitle',)),
+)
+
+def _generation(text, generations):
+    for name, markers in generations:
+        if all(m in text for m in markers):
+            return name
+
+def results_generation(text):
+    '''
+    Return the generation of the markup of the search results page text (a
+    unicode string) using a plain substring search, None if unknown.
+    '''
+    return _generation(text, RESULTS_GENERATIONS)
+
+def details_generation(text):
+    '''
+    Return the generation of the markup of the details page text (a unicode
+    string) using a plain substring search, None if unknown.
+    '''
+    return _generation(text, DETAILS_GENERATIONS)
+
+_stats_lock = Lock()
+_stats = {'lxml': 0, 'html5lib': 0, 'fallback': 0, 'partial': 0}
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def parser_stats():
+    '''
+    The number of pages parsed by each backend in this process, and how
+    often the lxml parser had to fall back to html5lib.
+    '''
+    with _stats_lock:
+        return dict(_stats)
+
+def parse_lxml(raw):
+    from lxml.html import document_fromstring
+    return document_fromstring(raw)
+
+def parse_html5lib(raw):
+    import html5lib
+    return html5lib.parse(raw, treebuilder='lxml', namespaceHTMLElements=False)
+
+def parse_html(raw, required=(), backend='lxml', log=None):
+    '''
+    Parse the unicode string raw. With the lxml backend the page is parsed
+    with lxml's C parser and html5lib is used only if that fails or if any
+    of the compiled xpath expressions in required does not match.
+    '''
+    if backend == 'lxml':
+        try:
+            root = parse_lxml(raw)
+        except Exception:
+            root = missing = None
+        else:
+            missing = [x.path for x in required if not x(root)]
+            if not missing:
+                _count('lxml')
+                return root
+        _count('fallback')
+        if log is not None:
+            stats = parser_stats()
+            log('lxml could not parse the page%s, using html5lib (%d of %d'
+                ' pages so far)' % (
+                    ' (missing: %s)' % ', '.join(missing) if missing else '',
+                    stats['fallback'], stats['lxml'] + stats['fallback']))
+    root = parse_html5lib(raw)
+    _count('html5lib')
+    return root
+
+# Partial parsing of details pages {{{
+
+# The parts of a details page the extractors in worker.py look at. Elements
+# with these ids or classes are kept along with everything inside them,
+# as are all h1 elements (title and old style authors)
+DETAILS_KEEP_IDS = frozenset((
+    'errorMessage', 'byline', 'bookDescription_feature_div', 'ps-content',
+    'productDescription', 'bookDetails_container_div', 'prodImage',
+    'original-main-image', 'main-image', 'main-image-container'))
+DETAILS_KEEP_CLASSES = frozenset((
+    'jumpBar', 'buying', 'crAvgStars', 'main-image-inner-wrapper'))
+
+def _details_keep(elem):
+    if elem.tag == 'h1':
+        return True
+    if elem.tag == 'link':
+        return elem.get('rel') == 'canonical'
+    return (elem.get('id') in DETAILS_KEEP_IDS or
+            elem.get('class') in DETAILS_KEEP_CLASSES or
+            elem.get('data-feature-name') == 'averageCustomerReviews')
+
+def _details_keep_siblings(elem):
+    # Old style authors follow the title, the book details and categories
+    # follow their headings
+    if elem.tag == 'h1':
+        return 'parseasinTitle' in (elem.get('class') or '')
+    if elem.tag == 'h2':
+        text = elem.text or ''
+        return text.startswith('基本信息') or '查找其它相似商品' in text
+    return False
+
+class DetailsPruner(object):
+
+    '''
+    Consumes the start and end events of a HTMLPullParser, removing every
+    element that is neither in a kept subtree nor has one inside it, as soon
+    as it ends.
+    '''
+
+    def __init__(self):
+        # Whether each open element is the root of a kept subtree
+        self.stack = []
+        self.keeping = 0
+        self.keep_siblings = set()
+
+    def __call__(self, events):
+        for event, elem in events:
+            if event == 'start':
+                parent = elem.getparent()
+                root = self.keeping == 0 and (_details_keep(elem) or
+                        (parent is not None and parent in self.keep_siblings))
+                self.stack.append(root)
+                if root:
+                    self.keeping += 1
+                continue
+            root = self.stack.pop()
+            if root:
+                self.keeping -= 1
+            elif self.keeping > 0:
+                continue
+            if _details_keep_siblings(elem):
+                self.keep_siblings.add(elem.getparent())
+            elif not root and len(elem) == 0:
+                # Nothing of interest in it
+                parent = elem.getparent()
+                if parent is not None:
+                    parent.remove(elem)
+
+def parse_details_partial(raw, required=(), chunk_size=64*1024):
+    '''
+    Parse the details page raw (a unicode string) with lxml keeping only the
+    subtrees the extractors need, and their ancestors. Everything else is
+    dropped as soon as the parser is done with it, so the complete tree never
+    exists. Returns None if any of the compiled xpath expressions in
+    required does not match, in which case the page should be parsed with
+    parse_html().
+    '''
+    from lxml.etree import HTMLPullParser
+    from lxml.html import HtmlElementClassLookup
+    parser = HTMLPullParser(events=('start', 'end'), encoding='utf-8')
+    parser.set_element_class_lookup(HtmlElementClassLookup())
+    prune = DetailsPruner()
+    try:
+        i = 0
+        while i < len(raw):
+            end = i + chunk_size
+            if '\ud800' <= raw[end-1:end] <= '\udbff':
+                # Do not split surrogate pairs on narrow builds
+                end += 1
+            parser.feed(raw[i:end].encode('utf-8'))
+            prune(parser.read_events())
+            i = end
+        root = parser.close()
+        prune(parser.read_events())
+    except Exception:
+        return None
+    if root is None or any(not x(root) for x in required):
+        return None
+    _count('partial')
+    return root
+# }}}
+
+def results_title_ok(title):
+    '''
+    False for search results that are never the book being looked for.
+    '''
+    title = title.lower()
+    bad = [u'套装', u'[有声书]', u'[音频cd]']
+    for x in bad:
+        if x in title:
+            return False
+    return True
+
+def results_url(href):
+    if href.startswith('/'):
+        href = 'http://www.amazon.cn%s' % (href)
+    return href
+
+# Streaming search results extractor {{{
+
+RESULTS_ORDER = ('s_access', 'result_div', 'mobile')
+
+class ResultsTarget(object):
+
+    '''
+    lxml parser target collecting the links to details pages of each
+    generation of the search results page markup, without building a tree.
+    It finds the same links as the xpaths used by
+    Amazon_CN.iter_results_page().
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.found = dict((k, []) for k in RESULTS_ORDER)
+        self.stack = []
+        # Depths of the currently open elements of interest
+        self.result_li = self.result_div = self.results = self.block = None
+        self.data_column = None
+        self.div_links = {}
+        self.block_link = None
+        # The link whose text is being collected: [kind, href, text, depth, ok]
+        self.link = None
+
+    def done(self):
+        for kind in RESULTS_ORDER:
+            if self.found[kind]:
+                return len(self.found[kind]) >= self.limit
+        return False
+
+    def start(self, tag, attrib):
+        parent = self.stack[-1] if self.stack else None
+        depth = len(self.stack)
+        self.stack.append(tag)
+        eid, cls, href = attrib.get('id', ''), attrib.get('class', ''), attrib.get('href', None)
+        if tag == 'li' and eid.startswith('result_') and self.result_li is None:
+            self.result_li = depth
+        elif tag == 'div':
+            if eid.startswith('result_') and self.result_div is None:
+                self.result_div, self.div_links = depth, {}
+            elif eid == 'Results' and self.results is None:
+                self.results = depth
+        elif tag == 'td':
+            if eid.startswith('search:Td:') and self.results is not None and self.block is None:
+                self.block, self.block_link = depth, None
+            elif cls == 'dataColumn' and self.block is not None and self.data_column is None:
+                self.data_column = depth
+        elif tag == 'a' and href is not None and self.link is None:
+            if self.result_li is not None and 's-access-detail-page' in cls:
+                self.link = ['s_access', href, [], depth, True]
+            elif self.result_div is not None and (cls == 'title' or parent == 'h3'):
+                kind = 'title' if cls == 'title' else 'h3'
+                if kind not in self.div_links:
+                    self.link = [kind, href, [], depth, True]
+            elif self.data_column is not None and self.block_link is None:
+                self.link = ['mobile', href, [], depth, False]
+        elif (tag == 'span' and self.link is not None and self.link[0] ==
+                'mobile' and depth == self.link[3] + 1 and cls == 'srTitle'):
+            self.link[4] = True
+
+    def end(self, tag):
+        if not self.stack:
+            return
+        self.stack.pop()
+        depth = len(self.stack)
+        link = self.link
+        if link is not None and depth == link[3]:
+            self.link = None
+            kind, href, text, ok = link[0], link[1], ''.join(link[2]), link[4]
+            if kind == 's_access':
+                if results_title_ok(text):
+                    self.found['s_access'].append(results_url(href))
+            elif kind in ('title', 'h3'):
+                self.div_links.setdefault(kind, (href, text))
+            elif ok:
+                self.block_link = (href, text)
+        if depth == self.result_li:
+            self.result_li = None
+        elif depth == self.result_div:
+            self.result_div = None
+            # A title link is preferred to a link in a h3, only the first one
+            # is considered
+            x = self.div_links.get('title', None) or self.div_links.get('h3', None)
+            if x is not None and results_title_ok(x[1]):
+                self.found['result_div'].append(results_url(x[0]))
+        elif depth == self.data_column:
+            self.data_column = None
+        elif depth == self.block:
+            self.block = None
+            if self.block_link is not None and results_title_ok(self.block_link[1]):
+                self.found['mobile'].append(results_url(self.block_link[0]))
+        elif depth == self.results:
+            self.results = None
+
+    def data(self, text):
+        if self.link is not None:
+            self.link[2].append(text)
+
+    def close(self):
+        for kind in RESULTS_ORDER:
+            if self.found[kind]:
+                return self.found[kind][:self.limit]
+        return []
+
+def response_charset(res):
+    '''
+    The charset of the Content-Type header of the response res, None if it
+    does not have one.
+    '''
+    import re
+    info = res.info() if callable(getattr(res, 'info', None)) else None
+    ctype = info.get('Content-Type', None) if info is not None else None
+    m = re.search(r'''charset=["']?([-\w]+)''', ctype or '', re.I)
+    return m.group(1) if m is not None else None
+
+def stream_results_page(raw, limit, encoding=None, chunk_size=16*1024):
+    '''
+    Yield the urls of up to limit details pages linked from the search
+    results page raw (bytes), without decoding the page or building a tree.
+    Links of the s-access generation of the markup, which is preferred to
+    all others, are yielded as soon as they are parsed, so that their
+    details pages can be downloaded while the rest of the page is parsed.
+    Those of older generations are yielded once the whole page is parsed.
+    Parsing stops as soon as enough links have been found. encoding is the
+    charset of the page given by the server, if any, see response_charset().
+    Otherwise it is taken from the page itself.
+    '''
+    import re
+    from lxml.etree import HTMLParser
+    if not encoding:
+        m = re.search(br'''<meta[^>]+charset=["']?([-\w]+)''', raw[:4096], re.I)
+        encoding = m.group(1).decode('ascii') if m is not None else 'utf-8'
+    target = ResultsTarget(limit)
+    parser = HTMLParser(target=target, encoding=encoding)
+    final = target.found[RESULTS_ORDER[0]]
+    sent = i = 0
+    while i < len(raw):
+        # The libxml2 push parser can stop reporting elements until it is
+        # closed when a chunk ends inside a tag, end chunks after one
+        end = raw.rfind(b'>', i, i + chunk_size) + 1
+        if end <= i:
+            end = i + chunk_size
+        parser.feed(raw[i:end])
+        i = end
+        while sent < min(len(final), limit):
+            yield final[sent]
+            sent += 1
+        if target.done():
+            break
+    for url in parser.close()[sent:]:
+        yield url
+# }}}
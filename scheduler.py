@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+from contextlib import contextmanager
+from threading import Lock, Semaphore
+
+class Throttled(Exception):
+
+    '''
+    Amazon.cn answered with a robot check or 503 page, it wants fewer
+    requests.
+    '''
+
+class CircuitOpen(Throttled):
+
+    '''
+    The request was not made, as Amazon.cn has been throttling recent ones.
+    '''
+
+def is_throttled_page(raw):
+    '''
+    True if raw (bytes) is the robot check page Amazon serves instead of
+    the requested page when it thinks it is getting too many requests.
+    '''
+    return b'/errors/validateCaptcha' in raw or b'Robot Check</title>' in raw
+
+def check_response(raw):
+    '''
+    Raise Throttled if the page raw is a robot check page. Call it inside
+    Scheduler.slot() so that the scheduler slows down.
+    '''
+    if is_throttled_page(raw):
+        raise Throttled('Amazon.cn served a robot check page')
+    return raw
+
+def is_throttle_error(e):
+    if isinstance(e, Throttled):
+        return True
+    code = getattr(e, 'code', None)
+    if code is None and callable(getattr(e, 'getcode', None)):
+        code = e.getcode()
+    return code == 503
+
+class Scheduler(object):  # {{{
+
+    '''
+    Paces the requests made to amazon.cn: at most max_concurrent requests are
+    in flight at any time and they are started at no more than rate requests
+    per second, with bursts of up to burst requests (a token bucket).
+
+    The rate adapts to Amazon: it is halved every time a request is
+    throttled and climbs back to rate as requests succeed. After
+    BREAKER_THRESHOLD throttled requests in a row the circuit breaker opens
+    and requests fail with CircuitOpen straight away, instead of tying up
+    threads, for BREAKER_COOLDOWN seconds. Then a single trial request is let
+    through, which closes the breaker if it succeeds and opens it again, for
+    twice as long, if it is throttled.
+    '''
+
+    MIN_RATE = 0.2
+    BREAKER_THRESHOLD = 3
+    BREAKER_COOLDOWN = 30
+    MAX_BREAKER_COOLDOWN = 600
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, rate=10, max_concurrent=5, burst=1):
+        self.max_rate, self.max_concurrent = float(rate), max_concurrent
+        self.rate = self.max_rate
+        self.burst = max(1, burst)
+        self.lock = Lock()
+        self.slots = Semaphore(max_concurrent)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.state = self.CLOSED
+        self.failures = self.trips = 0
+        self.cooldown = self.BREAKER_COOLDOWN
+        self.open_until = 0
+        self.trial = False
+
+    def wait(self):
+        '''
+        Block until a request may be started.
+        '''
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Take the token even if it is not there yet, so that callers
+            # queue up behind each other instead of all waking at once
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def admit(self):
+        '''
+        Raise CircuitOpen if the breaker does not let a request through now.
+        Returns True if the request is the trial of a half open breaker.
+        '''
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        with self.lock:
+            if self.state == self.OPEN and time.time() >= self.open_until:
+                self.state, self.trial = self.HALF_OPEN, False
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+        metrics.count('breaker', 'rejected')
+        raise CircuitOpen('Not contacting Amazon.cn, it is limiting requests')
+
+    def closed_in(self):
+        '''
+        Seconds until the breaker lets requests through again, 0 if it does
+        now. While the trial request of a half open breaker is in flight this
+        is a guess, as it depends on the outcome of the trial.
+        '''
+        with self.lock:
+            if self.state == self.OPEN:
+                return max(0, self.open_until - time.time())
+            if self.state == self.HALF_OPEN and self.trial:
+                return 1
+            return 0
+
+    def succeeded(self, trial=False):
+        with self.lock:
+            self.failures = 0
+            if trial or self.state == self.HALF_OPEN:
+                self.state, self.trial = self.CLOSED, False
+                self.cooldown = self.BREAKER_COOLDOWN
+            # Additive increase
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def throttled(self, trial=False):
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        metrics.count('throttled', 'requests')
+        with self.lock:
+            now = time.time()
+            # Multiplicative decrease, dropping the tokens saved up so far
+            self.rate = max(self.MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            self.last = now
+            self.failures += 1
+            if trial or self.state == self.HALF_OPEN:
+                self.cooldown = min(self.MAX_BREAKER_COOLDOWN, self.cooldown * 2)
+            elif self.state == self.OPEN or self.failures < self.BREAKER_THRESHOLD:
+                return
+            self.state, self.trial = self.OPEN, False
+            self.open_until = now + self.cooldown
+            self.trips += 1
+        metrics.count('breaker', 'tripped')
+
+    def gauges(self):
+        '''
+        The current rate and the breaker state, for the metrics file.
+        '''
+        with self.lock:
+            return {'rate': self.rate, 'breaker_open': int(self.state != self.CLOSED),
+                    'breaker_trips': self.trips}
+
+    @contextmanager
+    def slot(self):
+        '''
+        Context manager to wrap around every request. Raises CircuitOpen
+        instead of waiting if the circuit breaker is open. Requests failing
+        with a 503 error or with Throttled (see check_response()) slow down
+        the requests that follow.
+        '''
+        from calibre_plugins.AMAZON_CN.metrics import metrics
+        trial = self.admit()
+        st = time.time()
+        self.slots.acquire()
+        try:
+            if not trial:
+                # The breaker may have opened while waiting for the slot
+                trial = self.admit()
+            self.wait()
+            metrics.observe('schedule_wait', time.time() - st)
+            try:
+                yield
+            except Exception as e:
+                if is_throttle_error(e):
+                    self.throttled(trial)
+                elif trial:
+                    # Not Amazon limiting requests, let another trial through
+                    with self.lock:
+                        self.trial = False
+                raise
+            self.succeeded(trial)
+        finally:
+            self.slots.release()
+# }}}
+
+_schedulers = {}
+_schedulers_lock = Lock()
+
+def get_scheduler(rate=10, max_concurrent=5):
+    '''
+    Return the Scheduler for the given limits, shared by everything in this
+    process so that concurrent identify calls are paced together.
+    '''
+    key = (rate, max_concurrent)
+    with _schedulers_lock:
+        ans = _schedulers.get(key, None)
+        if ans is None:
+            ans = _schedulers[key] = Scheduler(rate=rate,
+                    max_concurrent=max_concurrent)
+        return ans
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Refresh the Amazon.cn metadata of a whole library. To run it use:
+#   calibre-debug -e sweep.py -- [options] [--library /path/to/library | --books books.json]
+#
+# Every book is looked up with Amazon_CN.identify_many(), which fills the
+# plugin's on-disk caches, so that downloading metadata for the books in
+# calibre afterwards does not need to contact Amazon.cn. The outcome for
+# every book is appended to a journal as soon as it is known. A sweep that
+# is interrupted (Ctrl+C, a crash, Amazon throttling) continues where it
+# stopped when run again with the same journal, as books swept in the last
+# --max-age days are skipped, unless their lookup failed. Books with fields
+# the plugin could fill that are empty go first, then the ones swept longest
+# ago. While Amazon is limiting requests the sweep pauses.
+
+import os, sys, json, time
+from threading import Event
+
+def load_journal(path):
+    '''
+    Return the last journal record of every book in the journal at path,
+    keyed by book id.
+    '''
+    ans = {}
+    if not os.path.exists(path):
+        return ans
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # Partly written by a sweep that was killed
+                continue
+            ans[rec['id']] = rec
+    return ans
+
+class Journal(object):  # {{{
+
+    '''
+    Append only record of the books swept. Every record is flushed to disk
+    as soon as it is written.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.records = load_journal(path)
+        self.stream = open(path, 'ab')
+
+    def record(self, book_id, status, **fields):
+        rec = dict(fields, id=book_id, status=status, time=time.time())
+        self.records[book_id] = rec
+        self.stream.write(json.dumps(rec, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+
+    def close(self):
+        self.stream.close()
+# }}}
+
+def library_books(library_path):
+    '''
+    Yield (book id, Metadata) for every book in the calibre library at
+    library_path.
+    '''
+    from calibre.library import db
+    cache = db(library_path).new_api
+    for book_id in cache.all_book_ids():
+        yield book_id, cache.get_metadata(book_id)
+
+def file_books(path):
+    '''
+    Yield (book id, Metadata) for every book in the JSON file at path, a list
+    of objects with title, authors, identifiers and optionally id keys.
+    '''
+    from calibre.ebooks.metadata.book.base import Metadata
+    with open(path, 'rb') as f:
+        books = json.loads(f.read())
+    for i, book in enumerate(books):
+        mi = Metadata(book.get('title', None), book.get('authors', None) or [])
+        mi.set_identifiers(book.get('identifiers', None) or {})
+        yield book.get('id', i), mi
+
+def schedule(plugin, books, journal, max_age):
+    '''
+    Return the books that need sweeping, in the order they should be swept:
+    those missing fields (see Amazon_CN.test_fields()) first, then never
+    swept, then swept longest ago. Books swept less than max_age seconds ago
+    are left out, unless their lookup failed.
+    '''
+    now = time.time()
+    ans = []
+    for book_id, mi in books:
+        rec = journal.records.get(book_id, None)
+        last = rec['time'] if rec is not None else None
+        if last is not None and now - last < max_age and rec['status'] != 'failed':
+            continue
+        missing = plugin.test_fields(mi) is not None
+        ans.append(((not missing, last is not None, last or 0), book_id, mi))
+    ans.sort(key=lambda x: x[0])
+    return [(book_id, mi) for key, book_id, mi in ans]
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    return '%dm%02ds' % (seconds // 60, seconds % 60)
+
+class Progress(object):  # {{{
+
+    '''
+    Prints the number of books swept, the throughput and the expected time
+    left, at most every interval seconds.
+    '''
+
+    def __init__(self, total, interval=10, stream=sys.stdout):
+        self.total, self.interval, self.stream = total, interval, stream
+        self.start = self.last = time.time()
+        self.done = 0
+        self.counts = {}
+        self.interrupted = False
+
+    def update(self, status):
+        self.done += 1
+        self.counts[status] = self.counts.get(status, 0) + 1
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        left = self.total - self.done
+        eta = format_duration(left / rate) if rate > 0 else '?'
+        counts = ', '.join('%d %s' % (v, k) for k, v in sorted(self.counts.iteritems()))
+        self.stream.write('Swept %d of %d books (%s) in %s, %.2f books/minute,'
+                ' ETA %s\n' % (self.done, self.total, counts,
+                    format_duration(elapsed), rate * 60, eta))
+        self.stream.flush()
+# }}}
+
+def sweep(plugin, books, journal, log, abort, max_age=30*24*3600,
+        concurrency=None, limit=None, progress_interval=10):
+    '''
+    Look up every book in books, a list of (book id, Metadata), that needs
+    it, recording the outcome in journal. Returns the Progress of the sweep.
+    '''
+    todo = schedule(plugin, books, journal, max_age)
+    if limit:
+        todo = todo[:limit]
+    progress = Progress(len(todo), interval=progress_interval)
+    lookups = [{'title': mi.title, 'authors': mi.authors,
+        'identifiers': mi.get_identifiers()} for book_id, mi in todo]
+    try:
+        for i, results, error in plugin.identify_many(log, lookups, abort,
+                concurrency=concurrency):
+            book_id, mi = todo[i]
+            if error is not None and not results:
+                # Tried again by the next sweep
+                journal.record(book_id, 'failed', error=error)
+                progress.update('failed')
+            elif results:
+                results.sort(key=plugin.identify_results_keygen(title=mi.title,
+                    authors=mi.authors, identifiers=mi.get_identifiers()))
+                best = results[0]
+                journal.record(book_id, 'found',
+                        asin=best.get_identifiers().get('amazon_cn', None),
+                        title=best.title, missing=plugin.test_fields(best))
+                progress.update('found')
+            else:
+                journal.record(book_id, 'not found')
+                progress.update('not found')
+    except KeyboardInterrupt:
+        # The lookups still running stop when they see abort
+        abort.set()
+        progress.interrupted = True
+    return progress
+
+def option_parser():
+    from optparse import OptionParser
+    parser = OptionParser(usage='calibre-debug -e sweep.py -- [options]')
+    parser.add_option('--library', default=None,
+            help='The calibre library to sweep, the current one by default')
+    parser.add_option('--books', default=None,
+            help='Sweep the books in this JSON file instead of a library')
+    parser.add_option('--journal', default=None,
+            help='Journal of the sweep, amazon_cn_sweep.jsonl in the library'
+            ' by default')
+    parser.add_option('--log', default=None,
+            help='File the log of every lookup is written to, the journal'
+            ' with .log added by default')
+    parser.add_option('--max-age', type='float', default=30,
+            help='Skip books swept less than this many days ago')
+    parser.add_option('--concurrency', type='int', default=None,
+            help='Books looked up at the same time, the plugin\'s maximum'
+            ' simultaneous downloads by default')
+    parser.add_option('--limit', type='int', default=None,
+            help='Sweep at most this many books')
+    parser.add_option('--progress-interval', type='float', default=10,
+            help='Seconds between progress reports')
+    return parser
+
+def main(args=sys.argv):
+    from calibre.ebooks.metadata.sources.base import create_log
+    from calibre_plugins.AMAZON_CN import Amazon_CN
+    opts, args = option_parser().parse_args(args[1:])
+    if opts.books:
+        books = list(file_books(opts.books))
+        journal_path = opts.journal or os.path.splitext(opts.books)[0] + '_sweep.jsonl'
+    else:
+        library = opts.library
+        if library is None:
+            from calibre.utils.config import prefs
+            library = prefs['library_path']
+        books = list(library_books(library))
+        journal_path = opts.journal or os.path.join(library, 'amazon_cn_sweep.jsonl')
+
+    plugin = Amazon_CN(None)
+    journal = Journal(journal_path)
+    abort = Event()
+    with open(opts.log or journal_path + '.log', 'ab') as logf:
+        log = create_log(logf)
+        print('Sweeping %d books, journal: %s' % (len(books), journal_path))
+        try:
+            progress = sweep(plugin, books, journal, log, abort,
+                    max_age=opts.max_age * 24 * 3600,
+                    concurrency=opts.concurrency, limit=opts.limit,
+                    progress_interval=opts.progress_interval)
+        finally:
+            journal.close()
+            plugin.dump_metrics(log)
+    progress.report()
+    if progress.interrupted:
+        print('Interrupted, run again with the same journal to continue')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,15 +13,26 @@ from threading import Thread
 
 from lxml.html import fromstring, tostring
 
+from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.library.comments import sanitize_comments_html
 from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.localization import canonicalize_lang
 
-def CSSSelect(expr):
-    from cssselect import HTMLTranslator
-    from lxml.etree import XPath
-    return XPath(HTMLTranslator().css_to_xpath(expr))
+from calibre_plugins.AMAZON_CN import xpaths
+from calibre_plugins.AMAZON_CN.metrics import (metrics, current_profile,
+        profiling)
+
+def shared_parse(result):
+    '''
+    A copy of the result of Worker.parse() for another worker.
+    '''
+    from calibre_plugins.AMAZON_CN.parsepool import (metadata_to_fields,
+            fields_to_metadata)
+    mi, attrs = result
+    if mi is not None:
+        mi = fields_to_metadata(metadata_to_fields(mi))
+    return mi, dict(attrs)
 
 class Worker(Thread):  # Get details {{{
 
@@ -30,15 +41,32 @@ class Worker(Thread):  # Get details {{{
     '''
 
     def __init__(self, url, result_queue, browser, log, relevance, plugin,
-            timeout=20, testing=False):
+            timeout=20, testing=False, clone_browser=True, cancel=None,
+            aborted=None):
         Thread.__init__(self)
         self.daemon = True
         self.testing = testing
         self.url, self.result_queue = url, result_queue
         self.log, self.timeout = log, timeout
         self.relevance, self.plugin = relevance, plugin
-        self.browser = browser.clone_browser()
+        # When run by a fetch engine the engine supplies the browser used to
+        # download the page, so there is no need for a clone per worker
+        self.browser = browser.clone_browser() if clone_browser else browser
         self.cover_url = self.amazon_id = self.isbn = None
+        self.not_found = False
+        # Why downloading the details page failed, None if it did not
+        self.error = None
+        # Set once the result of this worker is no longer wanted, a Cancel
+        # from cancel.py or an Event
+        self.cancel = cancel
+        # Set once the whole lookup is aborted, stops the cover probe too
+        self.aborted = aborted
+        # Generation of the page markup, used to try the matching extractors
+        # first
+        self.generation = None
+        # The work of this worker is part of the profile of the identify()
+        # creating it, whichever thread does it
+        self.profile = current_profile()
         from lxml.html import tostring
         self.tostring = tostring
 
@@ -60,24 +88,11 @@ class Worker(Thread):  # Get details {{{
         self.english_months = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
                 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
-        self.pd_xpath = '''
-            //h2[starts-with(text(), "基本信息")]/../div[@class="content"]
-            '''
-        self.publisher_xpath = '''
-            descendant::*[starts-with(text(), "出版社:")]
-            '''
         self.publisher_names = {'出版社'}
-
-        self.language_xpath =    '''
-            descendant::*[starts-with(text(), "语种：")]
-            '''
         self.language_names = {'语种'}
 
-        self.tags_xpath = '''
-            descendant::h2[text() = "\t 查找其它相似商品"]/../descendant::ul/li
-        '''
-
         self.ratings_pat = re.compile(r'(平均)([0-9.]+)( (星))')
+        self.large_image_pat = re.compile(br'"largeImage":"(http://[^"]+)",')
 
         lm = {
                 'eng': ('English', 'Englisch'),
@@ -116,22 +131,55 @@ class Worker(Thread):  # Get details {{{
             return ans
 
     def run(self):
-        try:
-            self.get_details()
-        except:
-            self.log.exception('get_details failed for url: %r'%self.url)
+        with profiling(self.profile):
+            try:
+                self.get_details()
+            except:
+                self.log.exception('get_details failed for url: %r'%self.url)
 
     def get_details(self):
-        from calibre.utils.cleantext import clean_ascii_chars
-        from calibre.ebooks.chardet import xml_to_unicode
-        import html5lib
+        page = [self.fetch()]
+        if page[0] is not None:
+            self.process(page)
 
+    def cancelled(self):
+        if self.cancel is not None and self.cancel.is_set():
+            metrics.count('cancelled', 'details')
+            return True
+        return False
+
+    def fetch(self, browser=None):
+        '''
+        Download the details page, returns None on failure or if the worker
+        was cancelled.
+        '''
+        from calibre_plugins.AMAZON_CN.cancel import Cancelled
+        from calibre_plugins.AMAZON_CN.flight import get_flight
+        if self.cancelled():
+            return
+        browser = browser or self.browser
         try:
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
+            # Workers of concurrent lookups of the same book share one download
+            raw = get_flight('details').do(self.url,
+                    lambda: self.download(browser))
+            if raw is None and not (self.cancel is not None and
+                    self.cancel.is_set()):
+                # The worker that downloaded it was cancelled, this one is not
+                raw = self.download(browser)
+            return raw
         except Exception as e:
+            from calibre_plugins.AMAZON_CN.scheduler import is_throttle_error
+            if isinstance(e, Cancelled) or self.cancelled():
+                return
+            if is_throttle_error(e):
+                self.log.error('Amazon is limiting requests, not downloading:'
+                        ' %r'%self.url)
+                self.error = 'Amazon.cn is limiting requests. Try again later.'
+                return
             if callable(getattr(e, 'getcode', None)) and \
                     e.getcode() == 404:
                 self.log.error('URL malformed: %r'%self.url)
+                self.not_found = True
                 return
             attr = getattr(e, 'args', [None])
             attr = attr if attr else [None]
@@ -141,31 +189,159 @@ class Worker(Thread):  # Get details {{{
             else:
                 msg = 'Failed to make details query: %r'%self.url
                 self.log.exception(msg)
+            self.error = msg
+
+    def download(self, browser):
+        from calibre_plugins.AMAZON_CN.cancel import scope
+        from calibre_plugins.AMAZON_CN.scheduler import check_response
+        with self.plugin.scheduler.slot():
+            # Waiting for the slot can take a while
+            if self.cancelled():
+                return
+            with scope(self.cancel), metrics.timer('fetch.details'):
+                raw = check_response(browser.open_novisit(self.url,
+                    timeout=self.timeout).read().strip())
+        metrics.count('bytes', 'details', len(raw))
+        return raw
+
+    def process(self, page):
+        '''
+        Parse the downloaded details page and put the result on the queue.
+        page is a list holding the bytes of the page, which are taken out of
+        it by parse_page(), so that they can be freed as soon as they are
+        decoded instead of staying alive, referenced by every caller, for the
+        whole parse.
+        '''
+        from calibre_plugins.AMAZON_CN.cancel import Cancelled
+        from calibre_plugins.AMAZON_CN.flight import get_flight
+        if self.cancelled():
+            return
+        # Workers of concurrent lookups of the same book share one parse
+        try:
+            mi, attrs = get_flight('parse').do(self.url,
+                    lambda: self.parse(page), share=shared_parse)
+        except Cancelled:
             return
+        finally:
+            # Also when the parse was remembered or made by another worker
+            del page[:]
+        for name, val in attrs.iteritems():
+            setattr(self, name, val)
+        if mi is not None and not self.cancelled():
+            mi.source_relevance = self.relevance
+            self.finish(mi)
+
+    def parse(self, page):
+        '''
+        Parse the downloaded details page, returning the metadata read from
+        it (or None) and the attributes of this worker set while parsing.
+        Raises Cancelled if the worker is cancelled before parsing, so that
+        a worker waiting for the same parse makes it instead of taking
+        nothing as the result. See process() for page.
+        '''
+        from calibre_plugins.AMAZON_CN.cancel import Cancelled
+        from calibre_plugins.AMAZON_CN.parsepool import (WORKER_ATTRIBUTES,
+                metadata_to_fields, fields_to_metadata)
+        # An unchanged page is not parsed again
+        cache = None if self.testing else self.plugin.response_cache
+        if cache is not None:
+            import hashlib
+            key = '%d.%d.%d:' % self.plugin.version + hashlib.sha1(page[0]).hexdigest()
+            try:
+                cached = cache.get_parsed(key)
+            except Exception:
+                self.log.exception('Failed to read remembered parse of: %r'%self.url)
+                cached = None
+            metrics.count('parse_cache', 'miss' if cached is None else 'hit')
+            if cached is not None:
+                fields, attrs = cached
+                return fields_to_metadata(fields), attrs
+        partial = self.plugin.prefs['partial_details'] and not self.testing
+        backend = self.plugin.prefs['parser']
+        pool = None if self.testing else self.plugin.parse_pool
+        mi = None
+        if self.cancelled():
+            raise Cancelled('Cancelled')
+        if pool is not None:
+            try:
+                mi = pool.parse(self, page[0], partial=partial, backend=backend,
+                        timeout=self.timeout)
+                # Parsed in the other process, not needed here any more
+                del page[:]
+            except Cancelled:
+                raise
+            except Exception:
+                self.log.exception('Failed to parse details page in a '
+                        'separate process, parsing it here instead')
+                pool = None
+        if pool is None:
+            mi = self.parse_page(page, partial=partial, backend=backend)
+        attrs = dict((x, getattr(self, x)) for x in WORKER_ATTRIBUTES)
+        if cache is not None and mi is not None:
+            try:
+                cache.set_parsed(key, (metadata_to_fields(mi), attrs))
+            except Exception:
+                self.log.exception('Failed to remember parse of: %r'%self.url)
+        return mi, attrs
 
-        oraw = raw
-        raw = xml_to_unicode(raw, strip_encoding_pats=True,
-                resolve_entities=True)[0]
+    def parse_page(self, page, partial=True, backend='lxml'):
+        '''
+        Parse the downloaded details page, returning the metadata read from
+        it or None. page is a list holding the bytes of the page, which are
+        taken out of it. Nothing here uses the plugin, so that it can run in
+        a separate process.
+        '''
+        from calibre.utils.cleantext import clean_ascii_chars
+        from calibre.ebooks.chardet import xml_to_unicode
+        from calibre_plugins.AMAZON_CN.parsing import (parse_html,
+                parse_details_partial, DETAILS_PAGE_REQUIRED, details_generation)
+
+        raw = oraw = page.pop()
+        if partial:
+            # Only the javascript cover url is needed from the raw bytes,
+            # do not keep them around while the page is parsed. The match
+            # object references the whole page too.
+            m = self.large_image_pat.search(oraw)
+            oraw = m.group() if m is not None else b''
+            del m
+        with metrics.timer('decode.details'):
+            raw = xml_to_unicode(raw, strip_encoding_pats=True,
+                    resolve_entities=True)[0]
         if '<title>404 - ' in raw:
             self.log.error('URL malformed: %r'%self.url)
+            self.not_found = True
             return
 
+        self.generation = details_generation(raw)
+        if self.generation is not None:
+            metrics.count('generation', 'details.' + self.generation)
+
         try:
-            root = html5lib.parse(clean_ascii_chars(raw), treebuilder='lxml',
-                    namespaceHTMLElements=False)
+            with metrics.timer('decode.details'):
+                raw = clean_ascii_chars(raw)
+            with metrics.timer('parse.details'):
+                root = None
+                if partial:
+                    root = parse_details_partial(raw,
+                            required=DETAILS_PAGE_REQUIRED)
+                if root is None:
+                    root = parse_html(raw, required=DETAILS_PAGE_REQUIRED,
+                            backend=backend, log=self.log)
         except:
             msg = 'Failed to parse amazon details page: %r'%self.url
             self.log.exception(msg)
             return
+        # Only the tree is needed from here on
+        del raw
 
-        errmsg = root.xpath('//*[@id="errorMessage"]')
+        errmsg = xpaths.error_message(root)
         if errmsg:
             msg = 'Failed to parse amazon details page: %r'%self.url
             msg += self.tostring(errmsg, method='text', encoding=unicode).strip()
             self.log.error(msg)
             return
 
-        self.parse_details(oraw, root)
+        return self.parse_details(oraw, root)
 
     def parse_details(self, raw, root):
         try:
@@ -233,7 +409,11 @@ class Worker(Thread):  # Get details {{{
             self.log.exception('Error parsing cover for url: %r'%self.url)
         mi.has_cover = bool(self.cover_url)
 
-        non_hero = CSSSelect('div#bookDetails_container_div div#nonHeroSection')(root)
+        non_hero = None
+        if self.generation != 'old':
+            non_hero = xpaths.non_hero(root)
+            if not non_hero:
+                self.generation_miss('details')
         if non_hero:
             # New style markup
             try:
@@ -241,7 +421,7 @@ class Worker(Thread):  # Get details {{{
             except:
                 self.log.exception('Failed to parse new-style book details section')
         else:
-            pd = root.xpath(self.pd_xpath)
+            pd = xpaths.product_details(root)
             if pd:
                 pd = pd[0]
 
@@ -273,36 +453,75 @@ class Worker(Thread):  # Get details {{{
                 self.log.warning('Failed to find product description for url: %r'%self.url)
 
         mi.source_relevance = self.relevance
+        return mi
 
+    def finish(self, mi):
+        '''
+        Remember what was found for the book and put it on the result queue.
+        '''
+        from calibre_plugins.AMAZON_CN.cover import scrm_cover_url
         if self.amazon_id:
+            # The bigger cover image is checked for in the background,
+            # whatever the check downloads is reused by download_cover
+            self.plugin.cover_probes.start(self.amazon_id,
+                    [scrm_cover_url(self.amazon_id)], self.browser, self.log,
+                    timeout=self.timeout, scheduler=self.plugin.scheduler,
+                    cancel=self.aborted)
             if self.isbn:
                 self.plugin.cache_isbn_to_identifier(self.isbn, self.amazon_id)
+            # Without a cover image on the page the probe decides whether
+            # there is a cover, otherwise it caches its url itself when it
+            # completes later
+            probe = self.plugin.cover_probes.get(self.amazon_id,
+                    timeout=0 if mi.has_cover else self.timeout)
+            if probe is not None:
+                self.cover_url = probe.url
+                mi.has_cover = True
             if self.cover_url:
                 self.plugin.cache_identifier_to_cover_url(self.amazon_id,
                         self.cover_url)
 
         self.plugin.clean_downloaded_metadata(mi)
 
-        self.result_queue.put(mi)
+        try:
+            self.plugin.cache_identifier_to_metadata(self.amazon_id, mi)
+        except:
+            self.log.exception('Failed to remember metadata for url: %r'%self.url)
+
+        with metrics.timer('queue_put'):
+            self.result_queue.put(mi)
 
+    @metrics.timed('field.asin')
     def parse_asin(self, root):
-        link = root.xpath('//link[@rel="canonical" and @href]')
+        link = xpaths.canonical_link(root)
         for l in link:
             return l.get('href').rpartition('/')[-1]
 
+    def generation_miss(self, field):
+        '''
+        Record that the extractor for the generation of the page markup did
+        not find field, so a fallback had to be used.
+        '''
+        if self.generation is not None:
+            metrics.count('generation_miss', 'details.%s.%s' % (
+                self.generation, field))
+
     def totext(self, elem):
         return self.tostring(elem, encoding=unicode, method='text').strip()
 
+    @metrics.timed('field.title')
     def parse_title(self, root):
-        h1 = root.xpath('//h1[@id="title"]')
-        if h1:
-            h1 = h1[0]
-            for child in h1.xpath('./*[contains(@class, "a-color-secondary")]'):
-                h1.remove(child)
-            return self.totext(h1)
-        tdiv = root.xpath('//h1[contains(@class, "parseasinTitle")]')[0]
-        ttdiv = tdiv.xpath('descendant::*[@id="btAsinTitle"]')[0]
-        actual_title = ttdiv.xpath('descendant::*[@style="padding-left: 0"]')
+        if self.generation != 'old':
+            h1 = xpaths.title_h1(root)
+            if h1:
+                h1 = h1[0]
+                for child in xpaths.title_h1_secondary(h1):
+                    h1.remove(child)
+                return self.totext(h1)
+            self.generation_miss('title')
+        tdiv = xpaths.title_old_h1(root)[0]
+        ttdiv = xpaths.title_old_asin(tdiv)[0]
+        actual_title = xpaths.title_old_actual(ttdiv)
         if actual_title:
             title = self.tostring(actual_title[0], encoding=unicode,
                     method='text').strip()
@@ -313,20 +532,20 @@ class Worker(Thread):  # Get details {{{
             ans = title.rpartition('[')[0].strip()
         return ans
 
+    @metrics.timed('field.authors')
     def parse_authors(self, root):
-        matches = CSSSelect('#byline .author .contributorNameID')(root)
-        if not matches:
-            matches = CSSSelect('#byline .author a.a-link-normal')(root)
-        if matches:
-            authors = [self.totext(x) for x in matches]
-            return [a for a in authors if a]
-
-        x = '//h1[contains(@class, "parseasinTitle")]/following-sibling::span/*[(name()="a" and @href) or (name()="span" and @class="contributorNameTrigger")]'
-        aname = root.xpath(x)
+        if self.generation != 'old':
+            matches = xpaths.authors_contributor(root)
+            if not matches:
+                matches = xpaths.authors_link(root)
+            if matches:
+                authors = [self.totext(x) for x in matches]
+                return [a for a in authors if a]
+            self.generation_miss('authors')
+
+        aname = xpaths.authors_old(root)
         if not aname:
-            aname = root.xpath('''
-            //h1[contains(@class, "parseasinTitle")]/following-sibling::*[(name()="a" and @href) or (name()="span" and @class="contributorNameTrigger")]
-                    ''')
+            aname = xpaths.authors_old_sibling(root)
         for x in aname:
             x.tail = ''
         authors = [self.tostring(x, encoding=unicode, method='text').strip() for x
@@ -334,54 +553,33 @@ class Worker(Thread):  # Get details {{{
         authors = [a for a in authors if a]
         return authors
 
+    @metrics.timed('field.rating')
     def parse_rating(self, root):
-        rating_paths = ('//div[@data-feature-name="averageCustomerReviews"]',
-                        '//div[@class="jumpBar"]/descendant::span[contains(@class,"asinReviewsSummary")]',
-                        '//div[@class="buying"]/descendant::span[contains(@class,"asinReviewsSummary")]',
-                        '//span[@class="crAvgStars"]/descendant::span[contains(@class,"asinReviewsSummary")]')
         ratings = None
-        for p in rating_paths:
-            ratings = root.xpath(p)
+        # The first path is for the new markup
+        paths = xpaths.rating_paths[1:] if self.generation == 'old' else xpaths.rating_paths
+        for p in paths:
+            ratings = p(root)
             if ratings:
                 break
+            if p is xpaths.rating_paths[0]:
+                self.generation_miss('rating')
         if ratings:
-            for elem in ratings[0].xpath('descendant::*[@title]'):
+            for elem in xpaths.rating_titles(ratings[0]):
                 t = elem.get('title').strip()
                 m = self.ratings_pat.match(t)
                 if m is not None:
                     return float(m.group(2))
 
     def _render_comments(self, desc):
-        from calibre.library.comments import sanitize_comments_html
-
-        for c in desc.xpath('descendant::noscript'):
-            c.getparent().remove(c)
-        for c in desc.xpath('descendant::*[@class="seeAll" or'
-                ' @class="emptyClear" or @id="collapsePS" or'
-                ' @id="expandPS"]'):
-            c.getparent().remove(c)
-
-        for a in desc.xpath('descendant::a[@href]'):
-            del a.attrib['href']
-            a.tag = 'span'
-        desc = self.tostring(desc, method='html', encoding=unicode).strip()
-
-        # Encoding bug in Amazon data U+fffd (replacement char)
-        # in some examples it is present in place of '
-        desc = desc.replace('\ufffd', "'")
-        # remove all attributes from tags
-        desc = re.sub(r'<([a-zA-Z0-9]+)\s[^>]+>', r'<\1>', desc)
-        # Collapse whitespace
-        # desc = re.sub('\n+', '\n', desc)
-        # desc = re.sub(' +', ' ', desc)
-        # Remove the notice about text referring to out of print editions
-        desc = re.sub(r'(?s)<em>--This text ref.*?</em>', '', desc)
-        # Remove comments
-        desc = re.sub(r'(?s)<!--.*?-->', '', desc)
-        return sanitize_comments_html(desc)
+        from calibre_plugins.AMAZON_CN.comments import render_comments
+        return sanitize_comments_html(render_comments(desc))
 
+    @metrics.timed('field.comments')
     def parse_comments(self, root):
-        ns = CSSSelect('#bookDescription_feature_div noscript')(root)
+        ns = None
+        if self.generation != 'old':
+            ns = xpaths.comments_noscript(root)
         if ns:
             ns = ns[0]
             if len(ns) == 0 and ns.text:
@@ -393,18 +591,19 @@ class Worker(Thread):  # Get details {{{
             return self._render_comments(ns)
 
         ans = ''
-        desc = root.xpath('//div[@id="ps-content"]/div[@class="content"]')
+        desc = xpaths.comments_ps_content(root)
         if desc:
             ans = self._render_comments(desc[0])
 
-        desc = root.xpath('//div[@id="productDescription"]/*[@class="content"]')
+        desc = xpaths.comments_product_description(root)
         if desc:
             ans += self._render_comments(desc[0])
         return ans
 
+    @metrics.timed('field.series')
     def parse_series(self, root):
         ans = (None, None)
-        desc = root.xpath('//div[@id="ps-content"]/div[@class="buying"]')
+        desc = xpaths.series_buying(root)
         if desc:
             raw = self.tostring(desc[0], method='text', encoding=unicode)
             raw = re.sub(r'\s+', ' ', raw)
@@ -415,12 +614,13 @@ class Worker(Thread):  # Get details {{{
                     ans = (s, i)
         return ans
 
+    @metrics.timed('field.tags')
     def parse_tags(self, root):
         ans = []
         exclude_tokens = {'kindle', 'a-z'}
         exclude = {u'kindle电子书', 'by authors', 'authors & illustrators', 'books', 'new; used & rental textbooks'}
         seen = set()
-        for li in root.xpath(self.tags_xpath):
+        for li in xpaths.tags(root):
             for i, a in enumerate(li.iterdescendants('a')):
                 if i > 0:
                     # we ignore the first category since it is almost always too broad
@@ -432,45 +632,30 @@ class Worker(Thread):  # Get details {{{
                         seen.add(lraw)
         return ans
 
+    @metrics.timed('field.cover')
     def parse_cover(self, root, raw=b""):
-        import urllib
-        imgs_url = 'http://z2-ec2.images-amazon.com/images/P/'+self.amazon_id+'.01.MAIN._SCRM_.jpg'
-
-        try:
-            res = urllib.urlopen(imgs_url)
-            code = res.getcode()
-            res.close()
-        except Exception,e:
-            code = 404
-
-        if code == 200:
-            return imgs_url
-
-        imgs = root.xpath('//img[(@id="prodImage" or @id="original-main-image" or @id="main-image") and @src]')
+        imgs = xpaths.cover_imgs(root)
         if not imgs:
-            imgs = root.xpath('//div[@class="main-image-inner-wrapper"]/img[@src]')
+            self.generation_miss('cover')
+            imgs = xpaths.cover_wrapper_imgs(root)
             if not imgs:
-                imgs = root.xpath('//div[@id="main-image-container"]//img[@src]')
+                imgs = xpaths.cover_container_imgs(root)
         if imgs:
             src = imgs[0].get('src')
             if 'loading-' in src:
-                js_img = re.search(br'"largeImage":"(http://[^"]+)",',raw)
+                js_img = self.large_image_pat.search(raw)
                 if js_img:
                     src = js_img.group(1).decode('utf-8')
             if ('/no-image-avail' not in src and 'loading-' not in src and '/no-img-sm' not in src):
                 self.log('Found image: %s' % src)
-                parts = src.split('/')
-                if len(parts) > 3:
-                    bn = parts[-1]
-                    sparts = bn.split('_')
-                    if len(sparts) > 2:
-                        bn = re.sub(r'\.\.jpg$', '.jpg', (sparts[0] + sparts[-1]))
-                        return ('/'.join(parts[:-1]))+'/'+bn
+                from calibre_plugins.AMAZON_CN.cover import full_size_cover_url
+                return full_size_cover_url(src)
 
+    @metrics.timed('field.new_details')
     def parse_new_details(self, root, mi, non_hero):
-        table = non_hero.xpath('descendant::table')[0]
-        for tr in table.xpath('descendant::tr'):
-            cells = tr.xpath('descendant::td')
+        table = xpaths.descendant_tables(non_hero)[0]
+        for tr in xpaths.descendant_trs(table):
+            cells = xpaths.descendant_tds(tr)
             if len(cells) == 2:
                 name = self.totext(cells[0])
                 val = self.totext(cells[1])
@@ -498,26 +683,27 @@ class Worker(Thread):  # Get details {{{
                     if ans:
                         self.isbn = mi.isbn = ans
 
+    @metrics.timed('field.isbn')
     def parse_isbn(self, pd):
-        items = pd.xpath(
-            'descendant::*[starts-with(text(), "ISBN")]')
+        items = xpaths.isbn(pd)
         if not items:
-            items = pd.xpath(
-                'descendant::b[contains(text(), "ISBN:")]')
+            items = xpaths.isbn_bold(pd)
         for x in reversed(items):
             if x.tail:
                 ans = check_isbn(x.tail.strip())
                 if ans:
                     return ans
 
+    @metrics.timed('field.publisher')
     def parse_publisher(self, pd):
-        for x in reversed(pd.xpath(self.publisher_xpath)):
+        for x in reversed(xpaths.publisher(pd)):
             if x.tail:
                 ans = x.tail.partition(';')[0]
                 return ans.partition('(')[0].strip()
 
+    @metrics.timed('field.pubdate')
     def parse_pubdate(self, pd):
-        for x in reversed(pd.xpath(self.publisher_xpath)):
+        for x in reversed(xpaths.publisher(pd)):
             if x.tail:
                 from calibre.utils.date import parse_only_date
                 ans = x.tail
@@ -525,8 +711,9 @@ class Worker(Thread):  # Get details {{{
                 date = self.delocalize_datestr(date)
                 return parse_only_date(date, assume_utc=True)
 
+    @metrics.timed('field.language')
     def parse_language(self, pd):
-        for x in reversed(pd.xpath(self.language_xpath)):
+        for x in reversed(xpaths.language(pd)):
             if x.tail:
                 raw = x.tail.strip().partition(',')[0].strip()
                 ans = self.lang_map.get(raw, None)
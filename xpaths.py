@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>; 2013, Bruce Chou <brucechou24@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# All the XPath and CSS selectors used to parse amazon.cn pages, compiled
+# once when the plugin is loaded and shared by every worker
+
+from lxml.etree import XPath
+
+# Maps the xpath of each compiled CSS selector to the CSS it came from
+css_sources = {}
+
+def css(expr):
+    from cssselect import HTMLTranslator
+    ans = XPath(HTMLTranslator().css_to_xpath(expr))
+    css_sources[ans.path] = expr
+    return ans
+
+error_message = XPath('//*[@id="errorMessage"]')
+
+# Search results page {{{
+result_links = XPath(r'//li[starts-with(@id, "result_")]//a[@href and contains(@class, "s-access-detail-page")]')
+# The result blocks of the current markup, for fast identify
+result_items = XPath(r'//li[starts-with(@id, "result_") and @data-asin]')
+result_item_links = XPath(r'descendant::a[@href and contains(@class, "s-access-detail-page")]')
+result_item_bylines = XPath(r'descendant::div[contains(@class, "a-row")][descendant::span[contains(@class, "a-color-secondary")]][1]/span[contains(@class, "a-color-secondary")]')
+result_item_stars = XPath(r'descendant::i[contains(@class, "a-icon-star")]/span[@class="a-icon-alt"]')
+result_item_imgs = XPath(r'descendant::img[contains(@class, "s-access-image") and @src]')
+# Previous generation of results page markup
+result_divs = XPath(r'//div[starts-with(@id, "result_")]')
+result_div_title_links = XPath(r'descendant::a[@class="title" and @href]')
+result_div_h3_links = XPath(r'descendant::h3/a[@href]')
+# Markup served to user agents Amazon thinks are mobile/less capable
+result_mobile_tds = XPath(r'//div[@id="Results"]/descendant::td[starts-with(@id, "search:Td:")]')
+result_mobile_links = XPath(r'descendant::td[@class="dataColumn"]/descendant::a[@href]/span[@class="srTitle"]/..')
+# }}}
+
+# Details page {{{
+canonical_link = XPath('//link[@rel="canonical" and @href]')
+
+title_h1 = XPath('//h1[@id="title"]')
+title_h1_secondary = XPath('./*[contains(@class, "a-color-secondary")]')
+title_old_h1 = XPath('//h1[contains(@class, "parseasinTitle")]')
+title_old_asin = XPath('descendant::*[@id="btAsinTitle"]')
+title_old_actual = XPath('descendant::*[@style="padding-left: 0"]')
+
+authors_contributor = css('#byline .author .contributorNameID')
+authors_link = css('#byline .author a.a-link-normal')
+authors_old = XPath('//h1[contains(@class, "parseasinTitle")]/following-sibling::span/*[(name()="a" and @href) or (name()="span" and @class="contributorNameTrigger")]')
+authors_old_sibling = XPath('''
+            //h1[contains(@class, "parseasinTitle")]/following-sibling::*[(name()="a" and @href) or (name()="span" and @class="contributorNameTrigger")]
+                    ''')
+
+rating_paths = tuple(XPath(x) for x in (
+    '//div[@data-feature-name="averageCustomerReviews"]',
+    '//div[@class="jumpBar"]/descendant::span[contains(@class,"asinReviewsSummary")]',
+    '//div[@class="buying"]/descendant::span[contains(@class,"asinReviewsSummary")]',
+    '//span[@class="crAvgStars"]/descendant::span[contains(@class,"asinReviewsSummary")]'))
+rating_titles = XPath('descendant::*[@title]')
+
+comments_noscript = css('#bookDescription_feature_div noscript')
+comments_ps_content = XPath('//div[@id="ps-content"]/div[@class="content"]')
+comments_product_description = XPath('//div[@id="productDescription"]/*[@class="content"]')
+comments_noscripts = XPath('descendant::noscript')
+comments_junk = XPath('descendant::*[@class="seeAll" or'
+                ' @class="emptyClear" or @id="collapsePS" or'
+                ' @id="expandPS"]')
+comments_links = XPath('descendant::a[@href]')
+
+series_buying = XPath('//div[@id="ps-content"]/div[@class="buying"]')
+
+tags = XPath('''
+            descendant::h2[text() = "\t 查找其它相似商品"]/../descendant::ul/li
+        ''')
+
+cover_imgs = XPath('//img[(@id="prodImage" or @id="original-main-image" or @id="main-image") and @src]')
+cover_wrapper_imgs = XPath('//div[@class="main-image-inner-wrapper"]/img[@src]')
+cover_container_imgs = XPath('//div[@id="main-image-container"]//img[@src]')
+
+non_hero = css('div#bookDetails_container_div div#nonHeroSection')
+descendant_tables = XPath('descendant::table')
+descendant_trs = XPath('descendant::tr')
+descendant_tds = XPath('descendant::td')
+
+product_details = XPath('''
+            //h2[starts-with(text(), "基本信息")]/../div[@class="content"]
+            ''')
+isbn = XPath('descendant::*[starts-with(text(), "ISBN")]')
+isbn_bold = XPath('descendant::b[contains(text(), "ISBN:")]')
+publisher = XPath('''
+            descendant::*[starts-with(text(), "出版社:")]
+            ''')
+language = XPath('''
+            descendant::*[starts-with(text(), "语种：")]
+            ''')
+# }}}
+
+def registry():
+    '''
+    All the compiled selectors in this module, as a mapping of name to XPath.
+    '''
+    ans = {}
+    for name, val in globals().items():
+        if isinstance(val, XPath):
+            ans[name] = val
+        elif isinstance(val, tuple) and val and isinstance(val[0], XPath):
+            for i, x in enumerate(val):
+                ans['%s_%d' % (name, i)] = x
+    return ans